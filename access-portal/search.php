@@ -6,7 +6,9 @@ if ($_REQUEST['q'] ?? '') {
   $query = $_REQUEST['q'];
   $query = preg_replace('/[^a-zA-Z0-9_" -]/', '', $query);
 
-  $command = "PYTHONIOENCODING=utf-8 ../search.py " . "../algolia_url.txt " . escapeshellarg($query);
+  $page = preg_replace('/[^0-9]/', '', $_REQUEST['page'] ?? '');
+
+  $command = "PYTHONIOENCODING=utf-8 ../search.py " . "../algolia_url.txt " . escapeshellarg($query) . " " . escapeshellarg($page ?: "0");
 
   $output = shell_exec($command);
   echo $output;
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""WSGI entry point for the reader.
+
+The PHP files in access-portal/ start a new Python process for every request.
+This module serves the same URLs from long-running worker processes instead,
+so the interpreter start-up, imports, config loading and HTTP connection setup
+are paid once per worker rather than once per page view, and in-process state
+(the pooled HTTP session, caches) survives between requests. Pages from the
+streaming renderers are sent chunk by chunk as they are produced.
+
+Query parameters are sanitized the same way the PHP files sanitize them.
+
+To run it with the built-in preforking server (run from access-portal/, so
+that relative paths in config.py resolve the same way they do for PHP):
+
+    ../app.py --port 8000 --workers 4
+
+Any WSGI server works too, e.g. gunicorn --chdir access-portal -w 4 app:application
+"""
+
+import argparse
+import os
+import re
+import sys
+import traceback
+from http.cookies import SimpleCookie
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import config
+import util
+import cache
+import posts
+import index
+import users
+import userlist
+import search
+import tag
+import chan
+import s
+
+ALGOLIA_URL_PATH = getattr(config, "ALGOLIA_URL_PATH", "../algolia_url.txt")
+
+COOKIE_CHECK_PAGE = """<html>
+    <head>
+        <meta http-equiv="refresh" content="1">
+    </head>
+    <body>
+        <p>Verifying that you are a human...</p>
+        <p>Please refresh the page to continue (if it does not automatically refresh).</p>
+    </body>
+</html>"""
+
+
+def _param(params, name):
+    return params.get(name, [""])[0]
+
+
+def _clean(value, pattern=r'[^a-zA-Z0-9_-]'):
+    return re.sub(pattern, '', value)
+
+
+def _display_format(params, allowed=("queries",)):
+    display_format = _param(params, "format")
+    return display_format if display_format in allowed else "html"
+
+
+def posts_page(params):
+    if _param(params, "commentId"):
+        # Same redirect as posts.php; see the comment there. Both values are
+        # IDs, and anything else (e.g. a decoded CR/LF) must not reach the
+        # header.
+        return ("302 Found", [("Location", "/posts.php?id=" + _clean(_param(params, "id"), r'[^a-zA-Z0-9]') +
+                               "#" + _clean(_param(params, "commentId"), r'[^a-zA-Z0-9]'))], "")
+    postid = _clean(_param(params, "id"))
+    if not postid:
+        return ("200 OK", [], 'Please enter a post ID as the "id" parameter in the URL.')
+    display_format = _display_format(params)
+    return ("200 OK", [], cache.page("posts", (postid, display_format),
+                                     lambda: posts.show_post_and_comment_thread(postid, display_format)))
+
+
+def index_page(params):
+    offset = int(_clean(_param(params, "offset"), r'[^0-9]') or "0")
+    view = _param(params, "view")
+    if view not in ("top", "old"):
+        view = "new"
+    before = _clean(_param(params, "before"), r'[^0-9a-zA-Z:-]')
+    after = _clean(_param(params, "after"), r'[^0-9a-zA-Z:-]')
+    display_format = _display_format(params)
+    return ("200 OK", [], cache.page("index", (offset, view, before, after, display_format),
+                                     lambda: index.show_daily_posts(offset, view, before, after, display_format)))
+
+
+def users_page(params):
+    if _param(params, "userid"):
+        userslug, status_code = util.userid_to_userslug(_clean(_param(params, "userid")))
+        if status_code != 200:
+            return ("200 OK", [], f"Received status code of {status_code} from API endpoint.")
+        return ("302 Found", [("Location", "./users.php?id=" + (userslug or ""))], "")
+    username = _clean(_param(params, "id"))
+    if not username:
+        return ("200 OK", [], "<pre>" +
+                'Please enter a username as the "id" parameter in the URL, and set format=rss or format=html.' + "\n" +
+                "For example, /users.php?id=vipulnaik&format=rss\n" +
+                "</pre>")
+    display_format = _display_format(params, allowed=("rss", "queries"))
+    if display_format == "rss":
+        return ("200 OK", [("Content-Type", "application/rss+xml")], users.feed_for_user(username))
+    return ("200 OK", [], users.html_page_for_user(username, display_format))
+
+
+def userlist_page(params):
+    sort = _param(params, "sort")
+    if sort not in ("postCount", "commentCount", "afKarma", "afPostCount", "afCommentCount"):
+        sort = "karma"
+    display_format = _display_format(params)
+    return ("200 OK", [], cache.page("userlist", (sort, display_format),
+                                     lambda: userlist.show_users_list(sort, display_format)))
+
+
+def search_page(params):
+    query = _clean(_param(params, "q"), r'[^a-zA-Z0-9_" -]')
+    if not query:
+        return ("200 OK", [], '<pre>Please enter your search term as the parameter "q" in the URL.</pre>')
+    page = int(_clean(_param(params, "page"), r'[^0-9]') or "0")
+    if not search.LOCAL_SEARCH and not search.ALGOLIA_URL:
+        search.load_algolia_url(ALGOLIA_URL_PATH)
+    return ("200 OK", [], search.show_search_results(query, page))
+
+
+def tag_page(params):
+    tagslug = _clean(_param(params, "slug"))
+    if not tagslug:
+        return ("200 OK", [], 'Please enter a tag slug as the "slug" parameter in the URL.')
+    return ("200 OK", [], tag.show_tag(tagslug, _display_format(params)))
+
+
+def chan_page(params):
+    postid = _clean(_param(params, "id"))
+    if not postid:
+        return ("200 OK", [], 'Please enter a post ID as the "id" parameter in the URL.')
+    return ("200 OK", [], chan.show_post_and_comment_thread(postid, _display_format(params)))
+
+
+def sequence_page(params):
+    sequenceid = _clean(_param(params, "id"))
+    if not sequenceid:
+        return ("200 OK", [], 'Please enter a sequence ID as the "id" parameter in the URL.')
+    return ("200 OK", [], s.show_sequence(sequenceid, _display_format(params)))
+
+
+ROUTES = {
+    "/": index_page,
+    "/index": index_page,
+    "/posts": posts_page,
+    "/users": users_page,
+    "/userlist": userlist_page,
+    "/search": search_page,
+    "/tag": tag_page,
+    "/chan": chan_page,
+    "/s": sequence_page,
+}
+
+
+def route(path, params):
+    """Find the page function for path. Besides /posts and /posts.php, the
+    "official" path style (/posts/<id>/<slug>, /users/<slug>, /s/<id>) is also
+    accepted, with the ID taken from the path."""
+    if path.endswith(".php"):
+        path = path[:-len(".php")]
+    if path in ROUTES:
+        return ROUTES[path]
+    parts = [part for part in path.split("/") if part]
+    if len(parts) >= 2 and "/" + parts[0] in ROUTES:
+        params.setdefault("slug" if parts[0] == "tag" else "id", [parts[1]])
+        return ROUTES["/" + parts[0]]
+    return None
+
+
+def application(environ, start_response):
+    headers = [("Set-Cookie", "humancheck=is_human; Max-Age=315360000; Secure; HttpOnly")]
+    # Same bot check as cookiecheck.inc: real browsers come back with the
+    # cookie we just set, most crawlers don't.
+    if not SimpleCookie(environ.get("HTTP_COOKIE", "")):
+        start_response("202 Accepted", headers + [("Content-Type", "text/html; charset=utf-8")])
+        return [COOKIE_CHECK_PAGE.encode("utf-8")]
+
+    # Some servers reuse a thread for many requests
+    cache.track_stale(restart=True)
+    params = parse_qs(environ.get("QUERY_STRING", ""))
+    page = route(environ.get("PATH_INFO", "/") or "/", params)
+    if page is None:
+        start_response("404 Not Found", headers + [("Content-Type", "text/plain; charset=utf-8")])
+        return [b"Not found"]
+
+    try:
+        status, page_headers, body = page(params)
+    except Exception:
+        traceback.print_exc(file=environ["wsgi.errors"])
+        start_response("500 Internal Server Error", headers + [("Content-Type", "text/plain; charset=utf-8")])
+        return [b"Internal server error"]
+
+    if not any(name == "Content-Type" for name, _ in page_headers):
+        page_headers.append(("Content-Type", "text/html; charset=utf-8"))
+    if isinstance(body, cache.CachedPage):
+        # Cached pages come already compressed
+        page_headers.append(("Vary", "Accept-Encoding"))
+        if "gzip" in environ.get("HTTP_ACCEPT_ENCODING", ""):
+            page_headers.append(("Content-Encoding", "gzip"))
+            page_headers.append(("Content-Length", str(len(body.gzipped))))
+            start_response(status, headers + page_headers)
+            return [body.gzipped]
+        page_headers.append(("Content-Length", str(len(body.body))))
+        start_response(status, headers + page_headers)
+        return [body.body]
+    start_response(status, headers + page_headers)
+    if isinstance(body, str):
+        return [body.encode("utf-8")]
+    return _encode_chunks(body, environ["wsgi.errors"])
+
+
+def _encode_chunks(chunks, errors):
+    """Encode the chunks of a streaming renderer as they are produced. By the
+    time a renderer fails the status line has already been sent, so all we can
+    do is log the error and end the response."""
+    try:
+        for chunk in chunks:
+            yield chunk.encode("utf-8")
+    except Exception:
+        traceback.print_exc(file=errors)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port, workers):
+    """Bind once, then fork workers that all accept on the same socket. Each
+    worker is itself threaded, so a slow upstream query only ties up one
+    thread."""
+    server = make_server(host, port, application, server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print("Serving on http://%s:%s with %s workers" % (host, port, workers), file=sys.stderr)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, 15)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the reader over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""Fill the local mirror (see mirror.py) with the whole history of the forum.
+
+./mirror.py sync only copies posts that are new or have new comments, so
+older posts are only in the mirror once someone comments on them. Running
+
+    ./backfill.py [PROCESSES]
+
+copies every post, month by month (the same windows as the archive sidebar on
+the front page, from index.archive_months), with the months split across
+PROCESSES worker processes (BACKFILL_PROCESSES in config.py by default), each
+syncing util.PAGE_CONCURRENCY posts at a time.
+
+All processes share the rate limiter in throttle.py, which keeps its state in
+the cache database, so the backfill never sends more than RATE_LIMIT queries
+per second in total (including those sent by the site itself). Workers wait
+for their turn instead of giving up after RATE_MAX_WAIT seconds as page views
+do. Like ./mirror.py sync, they neither read nor fill the response cache, so
+the backfill doesn't push the site's own responses out of it.
+
+Each month that is synced without errors is checkpointed in the mirror, so an
+interrupted backfill picks up where it left off when run again; months with
+errors are tried again on the next run. To see it working without querying
+the forum, point GRAPHQL_URL at ./fakeserver.py."""
+
+import datetime
+import multiprocessing
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+import config
+import index
+import mirror
+import throttle
+import util
+
+BACKFILL_PROCESSES = getattr(config, "BACKFILL_PROCESSES", 4)
+# posts_list_query returns this many posts at a time
+POSTS_PAGE_SIZE = 50
+
+
+def windows():
+    """Every month from the start of the archive up to this one, newest first,
+    as tuples (after, before)."""
+    today = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+    result = []
+    for year in range(index.ARCHIVE_START_YEAR, datetime.datetime.now(datetime.timezone.utc).year + 1):
+        for after, before, _ in index.archive_months(year):
+            if after <= today:
+                result.append((after, before))
+    return result[::-1]
+
+
+def _checkpoint_name(window):
+    return "backfill:%s:%s" % window
+
+
+def _start_worker():
+    mirror._syncing = True
+    util.skip_response_cache()
+    throttle.RATE_MAX_WAIT = float("inf")
+
+
+def backfill_window(window):
+    """Sync every post in window. Returns a tuple (window, number of posts,
+    number of posts that couldn't be synced, seconds taken); if the list of
+    posts couldn't be fetched, the number of failures is -1."""
+    start = time.time()
+    after, before = window
+    postids = []
+    offset = 0
+    while True:
+        page, status_code = index.posts_list_query(view="old", offset=offset, before=before, after=after)
+        if status_code != 200:
+            return (window, len(postids), -1, time.time() - start)
+        postids.extend(post["_id"] for post in page if post.get("_id") not in postids)
+        if len(page) < POSTS_PAGE_SIZE:
+            break
+        offset += len(page)
+    try:
+        failed = mirror.sync_posts(postids)
+    except Exception as e:
+        print("%s: %r" % (after[:7], e), file=sys.stderr)
+        failed = len(postids)
+    return (window, len(postids), failed, time.time() - start)
+
+
+def backfill(processes=BACKFILL_PROCESSES):
+    """Sync every month that hasn't been checkpointed yet. Returns the number
+    of months that had errors."""
+    all_windows = windows()
+    pending = [window for window in all_windows if mirror.state(_checkpoint_name(window)) is None]
+    print("%s of %s months to go, using %s processes" % (len(pending), len(all_windows), processes),
+          file=sys.stderr)
+    start = time.time()
+    done = synced = errors = 0
+    # Each worker gets its own connections and HTTP session rather than
+    # copies of ours
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, initializer=_start_worker) as pool:
+        for window, count, failed, seconds in pool.imap_unordered(backfill_window, pending):
+            done += 1
+            if failed == 0:
+                mirror.set_state(_checkpoint_name(window), "%s posts" % count)
+                synced += count
+            else:
+                errors += 1
+                synced += max(count - failed, 0)
+            elapsed = time.time() - start
+            remaining = elapsed / done * (len(pending) - done)
+            print("%s: %s posts in %.1fs%s | %s/%s months, %.1f posts/s, %d minutes to go" % (
+                window[0][:7], count, seconds,
+                "" if failed == 0 else " (%s)" % ("couldn't list posts" if failed < 0 else "%s failed" % failed),
+                done, len(pending), synced / elapsed if elapsed else 0, remaining / 60), file=sys.stderr)
+    return errors
+
+
+if __name__ == "__main__":
+    if sys.argv[2:] or (sys.argv[1:] and not sys.argv[1].isdigit()):
+        print("Usage: ./backfill.py [PROCESSES]")
+    elif mirror.MIRROR_PATH is None:
+        print("Set MIRROR_PATH in config.py first")
+    else:
+        with open(mirror.MIRROR_PATH + ".backfill.lock", "w") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    sys.exit("Another backfill is already running")
+            errors = backfill(int(sys.argv[1]) if sys.argv[1:] else BACKFILL_PROCESSES)
+            if errors:
+                sys.exit("%s months had errors; run ./backfill.py again to retry them" % errors)
+            print("Done")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""Benchmark comment thread rendering on synthetic threads.
+
+Compares the old recursive renderer (reproduced below, since it no longer
+exists in posts.py) against posts.build_comment_thread + posts.show_comment,
+for threads of increasing size in two shapes: "wide" threads, where each
+comment replies to a random earlier comment, and "deep" threads, where every
+comment replies to the one before it. Run as
+
+    ./bench_comments.py [--recursion-limit N] [sizes...]
+
+Raising the recursion limit lets the old renderer finish on deep threads, which
+shows its quadratic copying.
+
+Both renderers are timed without the fragment cache (see cache.fragment), so
+that every run renders every comment.
+
+The network is never touched; only config.py needs to exist."""
+
+import random
+import sys
+import time
+
+import cache
+import config
+import posts
+import util
+
+LEGACY_RECURSION_LIMIT = 1000
+
+
+def synthetic_comments(n, shape):
+    rng = random.Random(0)
+    comments = []
+    for i in range(n):
+        if i == 0:
+            parent = None
+        elif shape == "deep":
+            parent = "c%s" % (i - 1)
+        else:
+            parent = rng.choice([None, "c%s" % rng.randrange(i)])
+        comments.append({
+            "_id": "c%s" % i,
+            "user": {"_id": "u%s" % (i % 50), "username": "user%s" % (i % 50),
+                     "displayName": "User %s" % (i % 50), "slug": "user-%s" % (i % 50),
+                     "bio": ""},
+            "userId": "u%s" % (i % 50),
+            "parentCommentId": parent,
+            "pageUrl": "https://forum.effectivealtruism.org/posts/abc/slug#c%s" % i,
+            "htmlBody": "<p>Comment %s, see <a href=\"https://forum.effectivealtruism.org/posts/xyz/other\">this</a>.</p>" % i,
+            "baseScore": i % 7,
+            "postedAt": "2020-01-01T00:00:00.000Z",
+        })
+    return comments
+
+
+def legacy_update_parity(comment_node, parity):
+    comment_node.parity = parity
+    for child in comment_node.children:
+        child_parity = "even" if parity == "odd" else "odd"
+        legacy_update_parity(child, child_parity)
+
+
+def legacy_show_comment_header(comment_node):
+    # posts.show_comment_header without the fragment cache, which the old
+    # renderer didn't have
+    comment = comment_node.data
+    color = config.COMMENT_COLOR if comment_node.parity == "odd" else "#FFFFFF"
+    result = ('''<div id="%s" style="border: 1px solid #B3B3B3; padding-left: 15px; padding-right: 0px; padding-bottom: 10px; padding-top: 10px; margin-left: 0px; margin-right: -1px; margin-bottom: 0px; margin-top: 10px; background-color: %s">''' % (comment['_id'], color))
+    result += posts.show_comment_body(comment)
+    if comment_node.children:
+        result += '<span style="font-size: 14px;">Replies from: '
+        result += ", ".join('<a href="#%s">%s</a>' % (child.commentid, util.safe_get(child.data, ['user', 'username']))
+                            for child in comment_node.children)
+        result += '</span>'
+    return result
+
+
+def legacy_show_comment(comment_node):
+    result = ""
+    if comment_node.data:
+        result += legacy_show_comment_header(comment_node)
+    for child in comment_node.children:
+        result += legacy_show_comment(child)
+    if comment_node.data:
+        result += "</details>"
+        result += "</div>"
+    return result
+
+
+def time_legacy(comments):
+    # The old renderer recursed once per nesting level, so deep threads need a
+    # raised recursion limit to finish at all (and still fail at the default)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), LEGACY_RECURSION_LIMIT))
+    start = time.perf_counter()
+    root = posts.build_comment_thread(comments)
+    legacy_update_parity(root, "even")
+    legacy_show_comment(root)
+    return time.perf_counter() - start
+
+
+def time_current(comments):
+    start = time.perf_counter()
+    root = posts.build_comment_thread(comments)
+    posts.show_comment(root)
+    return time.perf_counter() - start
+
+
+def run(function, comments):
+    try:
+        return "%.3fs" % function(comments)
+    except RecursionError:
+        return "RecursionError"
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--recursion-limit"]:
+        LEGACY_RECURSION_LIMIT = int(args[1])
+        args = args[2:]
+    sizes = [int(arg) for arg in args] or [1000, 2000, 5000, 10000]
+    # Otherwise each run would find the comments rendered by the runs before
+    # it (the threads of each size start with the same comments) in the
+    # fragment cache, and only the first run would render them all
+    cache.FRAGMENT_CACHE_MAX_BYTES = 0
+    print("%8s %6s %16s %16s" % ("comments", "shape", "before", "after"))
+    for shape in ["wide", "deep"]:
+        for n in sizes:
+            comments = synthetic_comments(n, shape)
+            print("%8s %6s %16s %16s" % (n, shape,
+                                         run(time_legacy, comments),
+                                         run(time_current, comments)))
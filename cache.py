@@ -0,0 +1,638 @@
+#!/usr/bin/env python3
+
+"""On-disk cache for responses from the API endpoint.
+
+The PHP front end starts a new Python process for every page view, so the
+cache lives in an SQLite database rather than in memory. SQLite takes care of
+locking, which means any number of processes can read and write the cache at
+the same time. Each entry has an expiry time that depends on the operation
+that produced it (see TTLS), and the total size of the cache is bounded by
+CACHE_MAX_BYTES; when it grows beyond that, the least recently used entries
+are evicted.
+
+Whole rendered pages are cached in the same database (see page), both as
+they are and gzip-compressed, so that they can be sent to browsers that
+accept gzip without compressing them again. Pages are tagged with the posts
+and users they show, so that they can be purged by post ID or user slug
+(./cache.py purge --post ID --user SLUG), and pages showing a post are purged
+as soon as a change in the post's commentCount is seen.
+
+There is also a much smaller in-memory cache of rendered HTML fragments (see
+fragment), which only pays off in long-running processes such as the workers
+started by app.py."""
+
+import argparse
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+import config
+
+CACHE_ENABLED = getattr(config, "CACHE_ENABLED", True)
+CACHE_PATH = getattr(config, "CACHE_PATH",
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.sqlite3"))
+CACHE_MAX_BYTES = getattr(config, "CACHE_MAX_BYTES", 256 * 1024 * 1024)
+FRAGMENT_CACHE_MAX_BYTES = getattr(config, "FRAGMENT_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+
+# Number of seconds a response stays fresh, by operation name. Operations not
+# listed here use DEFAULT_TTL. A TTL of 0 disables caching for that operation.
+DEFAULT_TTL = 60
+TTLS = {
+    "get_content_for_post": 5 * 60,
+    "get_comments_for_post": 2 * 60,
+    "query_question_answers": 2 * 60,
+    "query_replies_to_answer": 2 * 60,
+    "query_replies_to_answers": 2 * 60,
+    "posts_list_query": 2 * 60,
+    "recent_comments_query": 20,
+    "users_list_query": 60 * 60,
+    "query_user_info": 15 * 60,
+    "get_comments_for_user": 5 * 60,
+    "get_posts_for_user": 10 * 60,
+    "userid_to_userslug": 24 * 60 * 60,
+    "userslug_to_userid": 24 * 60 * 60,
+    "get_content_for_tag": 60 * 60,
+    "get_sequence": 60 * 60,
+    "get_chapter": 60 * 60,
+    "get_chapters": 60 * 60,
+    "get_sequence_with_chapters": 60 * 60,
+    # Algolia searches (search.py)
+    "search_posts": 10 * 60,
+    "search_comments": 10 * 60,
+    # knownids.py build walks through the whole site once; no point caching
+    "knownids_build": 0,
+}
+TTLS.update(getattr(config, "CACHE_TTLS", {}))
+
+# Responses saying that the requested post, user, tag or sequence doesn't
+# exist are cached for at most this many seconds, so that it shows up soon
+# after it is created.
+NEGATIVE_TTL = getattr(config, "CACHE_NEGATIVE_TTL", 60)
+
+# Number of seconds a rendered page stays fresh, by page name. A TTL of 0
+# disables caching for that page.
+PAGE_TTLS = {
+    "posts": 2 * 60,
+    "index": 60,
+    "userlist": 60 * 60,
+}
+PAGE_TTLS.update(getattr(config, "PAGE_CACHE_TTLS", {}))
+
+# Expired entries are kept (until evicted) so that they can still be used.
+# For this many seconds after expiring, an entry is served right away while it
+# is refreshed in the background...
+STALE_WHILE_REVALIDATE = getattr(config, "CACHE_STALE_WHILE_REVALIDATE", 60 * 60)
+# ...and for this many seconds after expiring, it is served if the API
+# endpoint returns an error or can't be reached.
+STALE_IF_ERROR = getattr(config, "CACHE_STALE_IF_ERROR", 7 * 24 * 60 * 60)
+
+# Only bump the access time of an entry if it hasn't been touched for this
+# many seconds, so that most cache hits don't need a write.
+ACCESS_RESOLUTION = 60
+
+_local = threading.local()
+
+_lock_fd = None
+_lock_fd_lock = threading.Lock()
+
+# The state of the page being rendered, if it is being rendered through page()
+_page_state = contextvars.ContextVar("page_state", default=None)
+# When the oldest stale response used for the page being rendered was cached
+# (see track_stale)
+_stale_since = contextvars.ContextVar("stale_since", default=None)
+
+_fragments = OrderedDict()
+_fragments_bytes = 0
+_fragments_lock = threading.Lock()
+
+
+class CachedPage(object):
+    """A page from the page cache. Iterating over it gives the page as a single
+    chunk, like the streaming renderers, so it can be printed the same way."""
+
+    def __init__(self, body, gzipped):
+        self.body = body
+        self.gzipped = gzipped
+
+    def __iter__(self):
+        yield self.body.decode("utf-8")
+
+
+class CachedResponse(object):
+    """Stands in for a requests.Response when the body comes from the cache.
+    It supports the parts of the interface that util.get_from_request uses.
+
+    If the body has already been decoded, passing it as decoded saves
+    decoding it again. It is handed out only once, since the caller may
+    modify it (e.g. util.join_users adds to comments) and the same response
+    can go to several callers (see util._coalesced_fetch)."""
+
+    def __init__(self, content, status_code=200, decoded=None):
+        self.content = content
+        self.status_code = status_code
+        if decoded is not None:
+            self._decoded = decoded
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        decoded = self.__dict__.pop("_decoded", None)
+        return decoded if decoded is not None else json.loads(self.content)
+
+
+def ttl_for(operation_name):
+    return TTLS.get(operation_name, DEFAULT_TTL)
+
+
+def response_key(url, operation_name, variables, document_hash=""):
+    """The cache key for a query: the operation and its variables (serialized
+    canonically, so that the order of the keys doesn't matter), along with the
+    hash of the document, so that entries made before a change to the query
+    aren't used."""
+    return hashlib.sha256("\0".join([url, operation_name or "", document_hash,
+                                      json.dumps(variables, sort_keys=True, separators=(",", ":"))]).encode("utf-8")).hexdigest()
+
+
+def _connect():
+    """Return this thread's connection to the cache database, opening it (and
+    creating the tables) if necessary. Connections are not shared across
+    threads or inherited across forks."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(CACHE_PATH, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            kind TEXT,
+            body BLOB,
+            size INTEGER,
+            created REAL,
+            expires REAL,
+            accessed REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+    conn.execute("INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pages (
+            key TEXT PRIMARY KEY,
+            name TEXT,
+            body BLOB,
+            gzipped BLOB,
+            size INTEGER,
+            created REAL,
+            expires REAL,
+            accessed REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)")
+    conn.execute("CREATE TABLE IF NOT EXISTS page_tags (tag TEXT, key TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS page_tags_tag ON page_tags (tag)")
+    conn.execute("CREATE INDEX IF NOT EXISTS page_tags_key ON page_tags (key)")
+    conn.execute("CREATE TABLE IF NOT EXISTS comment_counts (postid TEXT PRIMARY KEY, count INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS known_ids (item TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS user_slugs (slug TEXT PRIMARY KEY, userid TEXT, updated REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS user_slugs_userid ON user_slugs (userid, updated)")
+    # State shared by all processes for throttle.py
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS breakers (
+            operation TEXT PRIMARY KEY,
+            state TEXT,
+            failures INTEGER,
+            trips INTEGER,
+            until REAL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            tokens REAL,
+            updated REAL,
+            rate REAL,
+            blocked_until REAL
+        )
+    """)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def get(key):
+    """Return the cached body for key, or None if there is no fresh entry."""
+    if not CACHE_ENABLED:
+        return None
+    now = time.time()
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT body, expires, accessed FROM entries WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None or row[1] < now:
+            return None
+        if now - row[2] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+    except sqlite3.Error:
+        return None
+
+
+def get_entry(key):
+    """Return (body, created, expires) for key, even if the entry has expired,
+    as long as it is still usable as a stale response (see STALE_IF_ERROR).
+    Return None otherwise."""
+    if not CACHE_ENABLED:
+        return None
+    now = time.time()
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT body, created, expires, accessed FROM entries WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None or row[2] + max(STALE_WHILE_REVALIDATE, STALE_IF_ERROR) < now:
+            return None
+        if now - row[3] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return row[:3]
+    except sqlite3.Error:
+        return None
+
+
+def track_stale(restart=False):
+    """Start keeping track of stale responses used in the current context, if
+    that isn't being done already (or if restart is true). Threads started
+    from a copy of this context (see util.start_concurrently) report to the
+    same place."""
+    if restart or _stale_since.get() is None:
+        _stale_since.set([None])
+
+
+def note_stale(created):
+    """Record that a stale response, cached at time created, was used for the
+    page being rendered. Such pages are kept out of the page cache."""
+    holder = _stale_since.get()
+    if holder is not None and (holder[0] is None or created < holder[0]):
+        holder[0] = created
+    uncacheable_page()
+
+
+def stale_since():
+    """When the oldest stale response used in the current context was cached,
+    or None if no stale responses were used."""
+    holder = _stale_since.get()
+    return holder[0] if holder is not None else None
+
+
+def put(key, kind, body, ttl):
+    """Store body under key for ttl seconds, then evict least recently used
+    entries if the cache has grown beyond CACHE_MAX_BYTES."""
+    if not CACHE_ENABLED or ttl <= 0:
+        return
+    now = time.time()
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            old_size = row[0] if row else 0
+            conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (key, kind, body, len(body), now, now + ttl, now))
+            conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'",
+                         (len(body) - old_size,))
+            _evict(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error:
+        pass
+
+
+def _evict(conn):
+    total = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+    while total > CACHE_MAX_BYTES:
+        victims = conn.execute("""
+            SELECT 'entries', key, size, accessed FROM entries
+            UNION ALL
+            SELECT 'pages', key, size, accessed FROM pages
+            ORDER BY accessed LIMIT 100
+        """).fetchall()
+        if not victims:
+            break
+        for table, key, size, _ in victims:
+            if table == "entries":
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            else:
+                _delete_page(conn, key)
+            total -= size
+            if total <= CACHE_MAX_BYTES:
+                break
+    conn.execute("UPDATE meta SET value = ? WHERE name = 'total_bytes'", (max(total, 0),))
+
+
+def _lock_file():
+    global _lock_fd
+    with _lock_fd_lock:
+        if _lock_fd is None:
+            _lock_fd = os.open(CACHE_PATH + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        return _lock_fd
+
+
+@contextlib.contextmanager
+def lock(key):
+    """Hold an exclusive lock on key across all processes using the cache.
+    Each key locks one byte of a shared lock file (at an offset taken from the
+    key), so no lock files pile up. The locks are POSIX record locks, which
+    belong to the process, so this only keeps other processes out; threads are
+    kept apart by util.send_query itself."""
+    if not CACHE_ENABLED or fcntl is None:
+        yield
+        return
+    offset = int(key[:12], 16)
+    try:
+        fd = _lock_file()
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset)
+    except OSError:
+        # Better to send a duplicate query than none at all
+        yield
+        return
+    try:
+        yield
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
+
+
+def _delete_page(conn, key):
+    conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+    conn.execute("DELETE FROM page_tags WHERE key = ?", (key,))
+
+
+def transaction(function, *args):
+    """Run function(conn, *args) in a write transaction on the cache database
+    and return its result. Like the rest of the cache, errors from SQLite are
+    ignored, in which case None is returned."""
+    if not CACHE_ENABLED:
+        return None
+    try:
+        conn = _connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(conn, *args)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error:
+        return None
+
+
+def page_key(name, *args):
+    return hashlib.sha256("\0".join([name] + [str(arg) for arg in args]).encode("utf-8")).hexdigest()
+
+
+def get_page(key):
+    """Return the CachedPage stored under key, or None if there is no fresh
+    one."""
+    if not CACHE_ENABLED:
+        return None
+    now = time.time()
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT body, gzipped, expires, accessed FROM pages WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None or row[2] < now:
+            return None
+        if now - row[3] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE pages SET accessed = ? WHERE key = ?", (now, key))
+        return CachedPage(row[0], row[1])
+    except sqlite3.Error:
+        return None
+
+
+def _put_page(conn, key, name, body, tags, ttl):
+    now = time.time()
+    gzipped = gzip.compress(body, mtime=0)
+    size = len(body) + len(gzipped)
+    row = conn.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+    old_size = row[0] if row else 0
+    _delete_page(conn, key)
+    conn.execute("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 (key, name, body, gzipped, size, now, now + ttl, now))
+    conn.executemany("INSERT INTO page_tags VALUES (?, ?)", [(tag, key) for tag in tags])
+    conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'",
+                 (size - old_size,))
+    _evict(conn)
+
+
+def page(name, args, render):
+    """Return the page called name for args (a tuple of everything the page
+    depends on, such as its query parameters) from the page cache if it is
+    there. Otherwise return the chunks of render(), storing the page in the
+    cache once all of it has been produced.
+
+    While render runs, it can call tag_page to say which posts and users the
+    page shows, and uncacheable_page if the page shouldn't be stored (e.g.
+    because it is an error message)."""
+    ttl = PAGE_TTLS.get(name, 0)
+    if not CACHE_ENABLED or ttl <= 0:
+        return render()
+    key = page_key(name, *args)
+    cached = get_page(key)
+    if cached is not None:
+        return cached
+    return _render_and_store(key, name, render, ttl)
+
+
+def _render_and_store(key, name, render, ttl):
+    state = {"tags": set(), "cacheable": True}
+    chunks = []
+    track_stale(restart=True)
+    token = _page_state.set(state)
+    try:
+        result = render()
+    finally:
+        _page_state.reset(token)
+    if isinstance(result, str):
+        result = [result]
+    result = iter(result)
+    while True:
+        token = _page_state.set(state)
+        try:
+            chunk = next(result)
+        except StopIteration:
+            break
+        finally:
+            _page_state.reset(token)
+        chunks.append(chunk)
+        yield chunk
+    if state["cacheable"]:
+        transaction(_put_page, key, name, "".join(chunks).encode("utf-8"), state["tags"], ttl)
+
+
+def tag_page(*tags):
+    """Record that the page being rendered shows the given posts and users
+    (tags of the form "post:<id>" or "user:<slug>")."""
+    state = _page_state.get()
+    if state is not None:
+        state["tags"].update(tags)
+
+
+def uncacheable_page():
+    """Keep the page being rendered out of the page cache."""
+    state = _page_state.get()
+    if state is not None:
+        state["cacheable"] = False
+
+
+def _purge(conn, tags):
+    keys = set()
+    for tag in tags:
+        keys.update(key for (key,) in conn.execute("SELECT key FROM page_tags WHERE tag = ?", (tag,)))
+    freed = 0
+    for key in keys:
+        row = conn.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+        if row:
+            freed += row[0]
+        _delete_page(conn, key)
+    conn.execute("UPDATE meta SET value = MAX(value - ?, 0) WHERE name = 'total_bytes'", (freed,))
+    return len(keys)
+
+
+def purge(postids=(), userslugs=()):
+    """Remove every cached page that shows any of the given posts or users.
+    Return the number of pages removed."""
+    tags = ["post:" + postid for postid in postids] + ["user:" + slug for slug in userslugs]
+    return transaction(_purge, tags) or 0
+
+
+def _note_comment_counts(conn, counts):
+    changed = []
+    for postid, count in counts.items():
+        row = conn.execute("SELECT count FROM comment_counts WHERE postid = ?", (postid,)).fetchone()
+        if row is not None and row[0] != count:
+            changed.append("post:" + postid)
+        if row is None or row[0] != count:
+            conn.execute("INSERT OR REPLACE INTO comment_counts VALUES (?, ?)", (postid, count))
+    if changed:
+        _purge(conn, changed)
+
+
+def note_comment_counts(counts):
+    """Given a dict mapping post IDs to their commentCount as just received
+    from the API endpoint, purge the cached pages of posts whose count has
+    changed since it was last seen."""
+    if counts:
+        transaction(_note_comment_counts, counts)
+
+
+def add_known_ids(items):
+    """Record post IDs and user slugs seen in responses, for knownids.py."""
+    if items:
+        transaction(lambda conn: conn.executemany("INSERT OR IGNORE INTO known_ids VALUES (?)",
+                                                  [(item,) for item in items]))
+
+
+def is_known_id(item):
+    if not CACHE_ENABLED:
+        return False
+    try:
+        return _connect().execute("SELECT 1 FROM known_ids WHERE item = ?", (item,)).fetchone() is not None
+    except sqlite3.Error:
+        return False
+
+
+def _remember_user_slugs(conn, pairs, now):
+    conn.executemany("""
+        INSERT INTO user_slugs VALUES (?, ?, ?)
+        ON CONFLICT (slug) DO UPDATE SET userid = excluded.userid, updated = excluded.updated
+        WHERE userid != excluded.userid
+    """, [(slug, userid, now) for slug, userid in pairs])
+
+
+def remember_user_slugs(pairs):
+    """Record (slug, user ID) pairs seen in responses, so that
+    util.userslug_to_userid and util.userid_to_userslug don't need to ask the
+    API endpoint. Unlike the rest of the cache, these don't expire: the
+    mapping only changes when a user changes their slug, and then the new
+    slug is recorded the next time it is seen."""
+    if pairs:
+        transaction(_remember_user_slugs, list(pairs), time.time())
+
+
+def _user_slug_lookup(sql, value):
+    if not CACHE_ENABLED:
+        return None
+    try:
+        row = _connect().execute(sql, (value,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def userid_for_slug(slug):
+    return _user_slug_lookup("SELECT userid FROM user_slugs WHERE slug = ?", slug)
+
+
+def slug_for_userid(userid):
+    # If the user has changed their slug, the most recently seen one wins
+    return _user_slug_lookup("SELECT slug FROM user_slugs WHERE userid = ? ORDER BY updated DESC LIMIT 1",
+                             userid)
+
+
+def fragment(kind, doc, render, extra=()):
+    """Return render(), the HTML for part of a document such as a comment,
+    reusing the HTML from an earlier call if there was one. Entries are keyed
+    by the document's _id and a hash of its htmlBody and baseScore (plus
+    anything in extra that the HTML also depends on), so an edited comment gets
+    rendered again while the rest of its thread comes from the cache. The
+    least recently used fragments are dropped once they take up more than
+    FRAGMENT_CACHE_MAX_BYTES."""
+    global _fragments_bytes
+    if not CACHE_ENABLED or FRAGMENT_CACHE_MAX_BYTES <= 0:
+        return render()
+    digest = hashlib.blake2b(digest_size=16)
+    for value in (doc.get("htmlBody"), doc.get("baseScore")) + tuple(extra):
+        digest.update(repr(value).encode("utf-8"))
+        digest.update(b"\0")
+    key = (kind, doc.get("_id"), digest.digest())
+    with _fragments_lock:
+        html = _fragments.get(key)
+        if html is not None:
+            _fragments.move_to_end(key)
+            return html
+    html = render()
+    with _fragments_lock:
+        if key not in _fragments:
+            _fragments[key] = html
+            _fragments_bytes += len(html)
+            while _fragments_bytes > FRAGMENT_CACHE_MAX_BYTES and _fragments:
+                _, evicted = _fragments.popitem(last=False)
+                _fragments_bytes -= len(evicted)
+    return html
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    purge_parser = subparsers.add_parser("purge", help="Remove cached pages showing the given posts or users.")
+    purge_parser.add_argument("--post", action="append", default=[], help="Post ID (can be repeated)")
+    purge_parser.add_argument("--user", action="append", default=[], help="User slug (can be repeated)")
+    args = parser.parse_args()
+    if args.command == "purge":
+        print("Purged %s pages" % purge(postids=args.post, userslugs=args.user))
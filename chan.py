@@ -3,28 +3,54 @@
 import sys
 from urllib.parse import quote
 import datetime
+from typing import Iterator
 
 import config
 import util
 import linkpath
 import posts
+import cache
+import knownids
+
+
+def show_comment_body(comment):
+    """The parent link and body of a comment, which don't depend on the rest
+    of the thread."""
+    result = ""
+    if util.safe_get(comment, ['parentCommentId']):
+        result += '''<br/><a href="#%s" id="%s" class="reply-parent" onmouseover="showComment(this, '%s')" onmouseout="removeComment('%s')">&gt;&gt;%s</a><br/>''' % (
+                util.safe_get(comment, ['parentCommentId']),
+                util.safe_get(comment, ['parentCommentId']),
+                util.safe_get(comment, ['parentCommentId']),
+                util.safe_get(comment, ['parentCommentId']),
+                util.safe_get(comment, ['parentCommentId'])
+                )
+    result += util.clean_html_body(comment['htmlBody'])
+    return result
+
 
-def show_post_and_comment_thread(postid: str, display_format: str) -> str:
-    print("""<!DOCTYPE html>
+def show_post_and_comment_thread(postid: str, display_format: str) -> Iterator[str]:
+    result = """<!DOCTYPE html>
     <html>
-    """)
+    """
     run_query = False if display_format == "queries" else True
-    post_and_status_code = posts.get_content_for_post(postid, run_query=run_query)
-    if isinstance(post_and_status_code, str):
-        return "Returning since only want to display the queries."
-    post, status_code = post_and_status_code
-    if status_code != 200:
-        return util.error_message_string("posts", postid, status_code)
-    comments = posts.get_comments_for_post(postid, view="postCommentsOld", run_query=run_query)
-    if (not run_query) or util.safe_get(post, "question"):
-        answers = posts.query_question_answers(postid, run_query=run_query)
+    if run_query and not knownids.might_exist("post", postid):
+        # Not cached, as the ID can become known at any time (see knownids)
+        cache.uncacheable_page()
+        yield util.error_page("posts", postid, 404)
+        return
+    # The answers are only needed for question posts, but we fetch them at the
+    # same time as the post rather than wait to find out
+    futures = util.start_concurrently(
+        lambda: posts.get_content_for_post(postid, run_query=run_query),
+        lambda: posts.get_comments_for_post(postid, view="postCommentsOld", run_query=run_query,
+                                           with_users=False),
+        lambda: posts.query_question_answers(postid, run_query=run_query))
+    if not run_query:
+        yield result + "Returning since only want to display the queries."
+        return
 
-    print("""
+    result += ("""
     <head>
         <meta charset="utf-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=yes">
@@ -48,6 +74,20 @@ def show_post_and_comment_thread(postid: str, display_format: str) -> str:
     </head>
     """)
 
+    # The head doesn't depend on the post, so send it while the queries run
+    yield result
+
+    post_and_status_code, comments, all_answers = [future.result() for future in futures]
+    post, status_code = post_and_status_code
+    if status_code == 200 and post is None:
+        status_code = 404
+    if status_code != 200:
+        cache.uncacheable_page()
+        yield "<body>\n" + util.error_message_string("posts", postid, status_code) + "</body>\n</html>\n"
+        return
+    if util.safe_get(post, "question"):
+        answers = all_answers
+
     result = "<body>\n"
     result += util.show_navbar()
     result += '''<div id="wrapper">'''
@@ -81,14 +121,19 @@ def show_post_and_comment_thread(postid: str, display_format: str) -> str:
             # post['htmlBody'] is HTML without the table of contents anchors added
             # in, so we have to use a separate HTML provided by the
             # tableOfContents JSON
-            result += util.cleanHtmlBody(util.substitute_alt_links(util.safe_get(post, ['tableOfContents', 'html'])))
+            result += util.clean_html_body(util.safe_get(post, ['tableOfContents', 'html']))
     else:
-        result += util.cleanHtmlBody(util.substitute_alt_links(post['htmlBody']))
+        result += util.clean_html_body(post['htmlBody'])
 
     if util.safe_get(post, "question"):
         result += '<h2 id="answers">Answers</h2>'
+        yield result
+        result = ""
+        replies_by_answer, status_code = posts.query_replies_to_answers([answer["_id"] for answer in answers])
+        if status_code != 200:
+            yield util.error_message_string("posts", postid, status_code)
         for answer in answers:
-            result += posts.show_answer(answer)
+            yield posts.show_answer(answer, replies=replies_by_answer.get(answer["_id"], []))
 
     if util.safe_get(post, "question") and util.safe_get(post, ["tableOfContents", "sections"]):
         result += '''<h2 id="comments">''' + util.safe_get(post, ["tableOfContents", "sections"])[-1]["title"] + '</h2>\n'
@@ -106,10 +151,12 @@ def show_post_and_comment_thread(postid: str, display_format: str) -> str:
             else:
                 reply_graph[parentid] = [commentid]
 
+    yield result
+
     for comment in comments:
         color = config.COMMENT_COLOR
         commentid = comment['_id']
-        result += "<div>"  # this extra outer div will ensure that two very short comments aren't displayed side-by-side
+        result = "<div>"  # this extra outer div will ensure that two very short comments aren't displayed side-by-side
         result += ('''<div id="%s" style="border: 1px solid #B3B3B3; padding-left: 15px; padding-right: 15px; padding-bottom: 10px; padding-top: 10px; margin-left: 0px; margin-right: -1px; margin-bottom: 0px; margin-top: 10px; background-color: %s; display: inline-block;">''' % (commentid, color))
         result += '<span style="color: #117743; font-weight: 700;">Anonymous</span> '
         result += " ·\n"
@@ -124,18 +171,13 @@ def show_post_and_comment_thread(postid: str, display_format: str) -> str:
             for reply in reply_graph[commentid]:
                 result += ''' <a href="#%s" onmouseover="showComment(this, '%s')" onmouseout="removeComment('%s')">&gt;&gt;%s</a>''' % (reply, reply, reply, reply)
         result += '<br/>'
-        if util.safe_get(comment, ['parentCommentId']):
-            result += '''<br/><a href="#%s" id="%s" class="reply-parent" onmouseover="showComment(this, '%s')" onmouseout="removeComment('%s')">&gt;&gt;%s</a><br/>''' % (
-                    util.safe_get(comment, ['parentCommentId']),
-                    util.safe_get(comment, ['parentCommentId']),
-                    util.safe_get(comment, ['parentCommentId']),
-                    util.safe_get(comment, ['parentCommentId']),
-                    util.safe_get(comment, ['parentCommentId'])
-                    )
-        result += util.cleanHtmlBody(util.substitute_alt_links(comment['htmlBody']))
+        result += cache.fragment("chan-comment", comment, lambda: show_comment_body(comment),
+                                 extra=(util.safe_get(comment, ['parentCommentId']),))
         result += "</div></div>"
+        yield result
 
-    result += ("""
+    yield util.stale_notice()
+    yield ("""
     </div>
     </div>
 
@@ -165,11 +207,9 @@ def show_post_and_comment_thread(postid: str, display_format: str) -> str:
         </html>
     """)
 
-    return result
-
 if __name__ == "__main__":
     if len(sys.argv) != 2 + 1:
         print("Please enter a post ID as argument")
     else:
-        print(show_post_and_comment_thread(postid=sys.argv[1], display_format=sys.argv[2]))
+        util.print_chunks(show_post_and_comment_thread(postid=sys.argv[1], display_format=sys.argv[2]))
 
@@ -16,6 +16,17 @@ TITLE = "EA Forum Reader"
 # COMMENT_COLOR = "#F7F7F8"
 # TITLE = "LessWrong 2.0 Reader"
 
+# HTTP client settings. All queries in a process share one pooled keep-alive
+# session (see util.get_session). Timeouts are in seconds; retries only apply
+# to connection errors and 502/503/504 responses.
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+HTTP_RETRIES = 2
+# Long lists (e.g. every comment on a post) are fetched a window at a time,
+# with up to PAGE_CONCURRENCY windows in flight at once.
+PAGE_CONCURRENCY = 4
+
 EMAIL = ""
 email_path = Path("../EMAIL.txt")
 if not email_path.exists():
@@ -25,3 +36,64 @@ with open(email_path, "r") as f:
     EMAIL = next(f).strip()
     if not EMAIL:
         raise ValueError("Please specify an email in EMAIL.txt.")
+
+# Responses from the API endpoint are cached on disk in an SQLite database
+# (cache.sqlite3 next to the code, unless CACHE_PATH is set). CACHE_TTLS
+# overrides the per-operation freshness times in cache.TTLS, in seconds.
+CACHE_ENABLED = True
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_TTLS = {}
+# Expired responses are served right away (and refreshed in the background)
+# for CACHE_STALE_WHILE_REVALIDATE seconds after expiring, and served when the
+# API endpoint fails for CACHE_STALE_IF_ERROR seconds after expiring.
+CACHE_STALE_WHILE_REVALIDATE = 60 * 60
+CACHE_STALE_IF_ERROR = 7 * 24 * 60 * 60
+# Responses saying that a post, user, tag or sequence doesn't exist are
+# cached for at most this many seconds.
+CACHE_NEGATIVE_TTL = 60
+# Rendered pages are cached too; PAGE_CACHE_TTLS overrides cache.PAGE_TTLS.
+PAGE_CACHE_TTLS = {}
+
+# Rendered comments are also kept in memory, up to this many bytes per
+# process; this only helps long-running processes such as app.py's workers.
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Circuit breaker and rate limiter for the API endpoint (see throttle.py). An
+# operation is not queried for BREAKER_COOLDOWN seconds (doubling each time,
+# up to BREAKER_MAX_COOLDOWN) after BREAKER_THRESHOLD failures in a row, and
+# at most RATE_LIMIT queries per second are sent, in bursts of up to
+# RATE_BURST.
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30
+BREAKER_MAX_COOLDOWN = 10 * 60
+RATE_LIMIT = 10
+RATE_BURST = 20
+
+# In strict mode, requests for post IDs and user slugs that aren't known to
+# exist are turned away without querying the API endpoint. This needs a
+# snapshot of all IDs, made with ./knownids.py build; see knownids.py.
+KNOWN_IDS_STRICT = False
+
+# Send only the SHA-256 hash of each query instead of its full text (automatic
+# persisted queries; see queries.py). Only turn this on if the API endpoint
+# supports them.
+GRAPHQL_PERSISTED_QUERIES = False
+
+# Path of the local mirror of posts, comments, users and tags (see mirror.py),
+# e.g. "mirror.sqlite3". When set, pages are rendered from the mirror where
+# possible and ./mirror.py sync should be run regularly to keep it up to date.
+# Each sync looks again at everything posted in the last MIRROR_RESYNC_DAYS
+# days, to pick up edits. Anything synced more than MIRROR_MAX_AGE seconds ago
+# is fetched from the API endpoint instead (float("inf") to always use it).
+MIRROR_PATH = None
+MIRROR_RESYNC_DAYS = 3
+MIRROR_MAX_AGE = 24 * 60 * 60
+
+# Number of worker processes used by ./backfill.py to fill the mirror with
+# the whole history of the forum.
+BACKFILL_PROCESSES = 4
+
+# Answer searches from the full-text index in the local mirror (which needs
+# MIRROR_PATH) instead of sending them to Algolia. Run ./mirror.py reindex
+# once to index a mirror made before the index existed.
+LOCAL_SEARCH = False
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+"""A stand-in for the forum's GraphQL API endpoint, serving a made-up forum, for
+trying out the reader (and especially ./mirror.py sync and ./backfill.py)
+without sending any queries to the real site.
+
+    ./fakeserver.py [--port 8765] [--posts 2000] [--delay 0.05]
+
+then set GRAPHQL_URL = "http://localhost:8765/graphql" in config.py. The forum
+has the given number of posts spread evenly from the start of the archive to
+today, with comments, questions with answers and replies, users and tags, all
+generated from a fixed seed so that every run serves the same data. Each
+request is answered after --delay seconds, to stand in for the round trip to
+the real API endpoint.
+
+Only the parts of GraphQL that the reader's queries use are understood:
+a single query operation with variables, aliases, arguments and @include/@skip,
+against the post(s), comment(s), user(s) and tag(s) fields. Automatic
+persisted queries are supported too.
+
+POST requests to a path ending in /queries are answered like Algolia's
+multiple-queries endpoint (for search.py, whose ALGOLIA_URL can point at e.g.
+http://localhost:8765/1/indexes/*/queries), matching posts and comments that
+contain every word of the query."""
+
+import argparse
+import datetime
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, parse_qsl, urlparse
+
+TOKEN_RE = re.compile(r'\s+|,|#[^\n]*|("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?|[{}()\[\]:!$@=]|\w+)')
+
+
+class Parser(object):
+    """Just enough of a GraphQL parser for the reader's queries."""
+
+    def __init__(self, document):
+        self.tokens = [match.group(1) for match in TOKEN_RE.finditer(document) if match.group(1)]
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError("Expected %s, found %s" % (expected, token))
+        self.position += 1
+        return token
+
+    def document(self):
+        """The top-level selection set of the (only) operation."""
+        if self.peek() == "query":
+            self.take()
+            if self.peek() not in ("(", "{"):
+                self.take()
+            if self.peek() == "(":
+                # Variable definitions; the values are all in the request
+                depth = 0
+                while True:
+                    token = self.take()
+                    depth += {"(": 1, ")": -1}.get(token, 0)
+                    if depth == 0:
+                        break
+        return self.selection_set()
+
+    def selection_set(self):
+        self.take("{")
+        selections = []
+        while self.peek() != "}":
+            alias = name = self.take()
+            if self.peek() == ":":
+                self.take()
+                name = self.take()
+            arguments = self.arguments() if self.peek() == "(" else {}
+            directives = []
+            while self.peek() == "@":
+                self.take()
+                directives.append((self.take(), self.arguments()))
+            children = self.selection_set() if self.peek() == "{" else None
+            selections.append((alias, name, arguments, directives, children))
+        self.take("}")
+        return selections
+
+    def arguments(self):
+        self.take("(")
+        arguments = {}
+        while self.peek() != ")":
+            name = self.take()
+            self.take(":")
+            arguments[name] = self.value()
+        self.take(")")
+        return arguments
+
+    def value(self):
+        token = self.take()
+        if token == "$":
+            return ("variable", self.take())
+        if token == "{":
+            fields = {}
+            while self.peek() != "}":
+                name = self.take()
+                self.take(":")
+                fields[name] = self.value()
+            self.take("}")
+            return fields
+        if token == "[":
+            values = []
+            while self.peek() != "]":
+                values.append(self.value())
+            self.take("]")
+            return values
+        if token.startswith('"'):
+            return json.loads(token)
+        if token in ("true", "false", "null"):
+            return {"true": True, "false": False, "null": None}[token]
+        if re.match(r'-?\d', token):
+            return json.loads(token)
+        return token  # enum value
+
+
+def resolve_value(value, variables):
+    """Substitute the variables into an argument value."""
+    if isinstance(value, tuple):
+        return variables.get(value[1])
+    if isinstance(value, dict):
+        return {key: resolve_value(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_value(item, variables) for item in value]
+    return value
+
+
+class Forum(object):
+    """The made-up forum."""
+
+    def __init__(self, post_count, start_year=2011, seed=0):
+        rng = random.Random(seed)
+        self.users = [{"_id": "fakeuser%09d" % i, "slug": "user-%d" % i, "username": "user%d" % i,
+                       "displayName": "User %d" % i, "bio": "Bio of user %d" % i,
+                       "htmlBio": "<p>Bio of user %d</p>" % i, "karma": rng.randint(0, 10000),
+                       "website": "", "location": "", "postCount": 0, "commentCount": 0,
+                       "afKarma": 0, "afPostCount": 0, "afCommentCount": 0}
+                      for i in range(max(post_count // 10, 10))]
+        self.tags = [{"_id": "faketag%010d" % i, "slug": "tag-%d" % i, "name": "Tag %d" % i,
+                      "description": {"html": "<p>About tag %d</p>" % i}} for i in range(20)]
+        self.posts = []
+        self.comments = []
+        start = datetime.datetime(start_year, 1, 1, tzinfo=datetime.timezone.utc)
+        span = (datetime.datetime.now(datetime.timezone.utc) - start).total_seconds()
+        for i in range(post_count):
+            posted_at = start + datetime.timedelta(seconds=span * i / max(post_count, 1))
+            author = rng.choice(self.users)
+            author["postCount"] += 1
+            post = {"_id": "fakepost%09d" % i, "title": "Post number %d" % i, "slug": "post-number-%d" % i,
+                    "postedAt": posted_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                    "pageUrl": "https://forum.effectivealtruism.org/posts/fakepost%09d/post-number-%d" % (i, i),
+                    "htmlBody": "<p>Body of post %d.</p>" % i, "baseScore": rng.randint(0, 200),
+                    "voteCount": rng.randint(0, 100), "commentCount": 0, "meta": False,
+                    "question": i % 10 == 0, "url": None, "canonicalSource": None, "legacyId": None,
+                    "tableOfContents": None, "userId": author["_id"], "user": author, "coauthors": []}
+            self.posts.append(post)
+            answers = rng.randint(1, 3) if post["question"] else 0
+            for j in range(rng.randint(0, 12) + answers):
+                commenter = rng.choice(self.users)
+                commenter["commentCount"] += 1
+                # Earlier comments on this post
+                previous = self.comments[len(self.comments) - j:]
+                parent = rng.choice(previous) if previous and rng.random() < 0.5 else None
+                comment = {"_id": "fakecmnt%09d" % len(self.comments), "postId": post["_id"], "post": post,
+                           "userId": commenter["_id"], "user": commenter, "author": commenter["username"],
+                           "postedAt": (posted_at + datetime.timedelta(hours=j + 1)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                           "htmlBody": "<p>Comment %d on post %d.</p>" % (j, i), "baseScore": rng.randint(0, 50),
+                           "voteCount": rng.randint(0, 20), "answer": j < answers,
+                           "parentCommentId": None if j < answers or parent is None else parent["_id"],
+                           "parentAnswerId": None}
+                if not comment["answer"] and comment["parentCommentId"] is not None:
+                    comment["parentAnswerId"] = parent["_id"] if parent["answer"] else parent["parentAnswerId"]
+                comment["pageUrl"] = post["pageUrl"] + "?commentId=" + comment["_id"]
+                self.comments.append(comment)
+                post["commentCount"] += 1
+        self.posts_by_id = {post["_id"]: post for post in self.posts}
+        self.users_by_id = {user["_id"]: user for user in self.users}
+        self.users_by_slug = {user["slug"]: user for user in self.users}
+        self.tags_by_slug = {tag["slug"]: tag for tag in self.tags}
+
+    def field(self, name, arguments):
+        selector = arguments.get("input", {}).get("selector") or {}
+        terms = arguments.get("input", {}).get("terms") or {}
+        if name == "post":
+            return {"result": self.posts_by_id.get(selector.get("_id") or selector.get("documentId"))}
+        if name == "user":
+            if "slug" in selector:
+                return {"result": self.users_by_slug.get(selector["slug"])}
+            return {"result": self.users_by_id.get(selector.get("documentId") or selector.get("_id"))}
+        if name == "tag":
+            return {"result": self.tags_by_slug.get(selector.get("slug"))}
+        if name == "posts":
+            return {"results": self.page(self.list_posts(terms), terms, 20)}
+        if name == "comments":
+            return {"results": self.page(self.list_comments(terms), terms, 1000)}
+        if name == "users":
+            users = sorted(self.users, key=lambda user: -user.get(next(iter(terms.get("sort") or {"karma": -1})), 0))
+            return {"results": self.page(users, terms, 50)}
+        if name == "tags":
+            return {"results": self.page(self.tags, terms, 50)}
+        return None
+
+    def page(self, items, terms, default_limit):
+        offset = terms.get("offset") or 0
+        return items[offset:offset + (terms.get("limit") or default_limit)]
+
+    def list_posts(self, terms):
+        posts = self.posts
+        view = terms.get("view")
+        if view == "userPosts":
+            posts = [post for post in posts if post["userId"] == terms.get("userId")]
+        if terms.get("after"):
+            posts = [post for post in posts if post["postedAt"][:10] >= terms["after"][:10]]
+        if terms.get("before"):
+            posts = [post for post in posts if post["postedAt"][:10] <= terms["before"][:10]]
+        if view == "top":
+            return sorted(posts, key=lambda post: -post["baseScore"])
+        return posts if view == "old" else posts[::-1]
+
+    def list_comments(self, terms):
+        view = terms.get("view")
+        if view in ("postCommentsTop", "postCommentsOld", "postCommentsNew"):
+            comments = [comment for comment in self.comments if comment["postId"] == terms.get("postId")
+                        and not comment["answer"] and comment["parentAnswerId"] is None]
+            if view == "postCommentsTop":
+                return sorted(comments, key=lambda comment: -comment["baseScore"])
+            return comments if view == "postCommentsOld" else comments[::-1]
+        if view == "questionAnswers":
+            return [comment for comment in self.comments
+                    if comment["postId"] == terms.get("postId") and comment["answer"]]
+        if view == "repliesToAnswer":
+            return [comment for comment in self.comments if comment["parentAnswerId"] == terms.get("parentAnswerId")]
+        if view == "userComments":
+            return [comment for comment in self.comments if comment["userId"] == terms.get("userId")][::-1]
+        return self.comments[::-1]  # recentComments
+
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def search_hit(document):
+    """A post or comment as an Algolia hit."""
+    user = document["user"]
+    hit = {"_id": document["_id"], "postedAt": document["postedAt"], "userId": user["_id"],
+           "authorSlug": user["slug"], "authorDisplayName": user["displayName"],
+           "authorUserName": user["username"], "body": TAG_RE.sub("", document["htmlBody"])}
+    if "post" in document:
+        hit.update(postId=document["postId"], postTitle=document["post"]["title"])
+    else:
+        hit.update(title=document["title"], slug=document["slug"])
+    return hit
+
+
+def algolia_search(forum, index_name, query, hits_per_page, page):
+    """Answer one query of an Algolia multiple-queries request."""
+    words = query.lower().replace('"', " ").split()
+    documents = forum.posts if index_name.endswith("posts") else forum.comments
+    hits = []
+    for document in reversed(documents):
+        text = (document.get("title", "") + " " + TAG_RE.sub(" ", document["htmlBody"])).lower()
+        if words and all(word in text for word in words):
+            hits.append(search_hit(document))
+    return {"hits": hits[page * hits_per_page:(page + 1) * hits_per_page], "nbHits": len(hits),
+            "page": page, "hitsPerPage": hits_per_page}
+
+
+def project(value, selections, variables):
+    """The parts of value asked for by the selection set."""
+    if isinstance(value, list):
+        return [project(item, selections, variables) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for alias, name, arguments, directives, children in selections:
+        included = True
+        for directive, directive_arguments in directives:
+            condition = bool(resolve_value(directive_arguments.get("if"), variables))
+            included = included and (condition if directive == "include" else not condition)
+        if included:
+            result[alias] = value.get(name) if children is None else project(value.get(name), children, variables)
+    return result
+
+
+def execute(forum, document, variables):
+    data = {}
+    for alias, name, arguments, directives, children in Parser(document).document():
+        value = forum.field(name, resolve_value(arguments, variables))
+        data[alias] = value if children is None else project(value, children, variables)
+    return {"data": data}
+
+
+class Handler(BaseHTTPRequestHandler):
+    forum = None
+    delay = 0
+    persisted = {}
+    persisted_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        parameters = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        self.answer(parameters.get("query"), json.loads(parameters.get("variables") or "{}"),
+                    json.loads(parameters.get("extensions") or "{}"))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if urlparse(self.path).path.endswith("/queries"):
+            time.sleep(self.delay)
+            results = []
+            for request in body.get("requests", []):
+                params = dict(parse_qsl(request.get("params", "")))
+                results.append(algolia_search(self.forum, request.get("indexName", ""), params.get("query", ""),
+                                              int(params.get("hitsPerPage", 20)), int(params.get("page", 0))))
+            return self.send({"results": results})
+        self.answer(body.get("query"), body.get("variables") or {}, body.get("extensions") or {})
+
+    def answer(self, document, variables, extensions):
+        time.sleep(self.delay)
+        sha256 = (extensions.get("persistedQuery") or {}).get("sha256Hash")
+        with self.persisted_lock:
+            if sha256 and document:
+                self.persisted[sha256] = document
+            elif sha256:
+                document = self.persisted.get(sha256)
+                if document is None:
+                    return self.send({"errors": [{"message": "PersistedQueryNotFound",
+                                                  "extensions": {"code": "PERSISTED_QUERY_NOT_FOUND"}}]})
+        try:
+            response = execute(self.forum, document or "", variables)
+        except (ValueError, AttributeError, TypeError) as e:
+            return self.send({"errors": [{"message": str(e)}]}, status_code=400)
+        self.send(response)
+
+    def send(self, response, status_code=200):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a made-up forum from a fake GraphQL API endpoint.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--delay", type=float, default=0.05,
+                        help="seconds to wait before answering each request")
+    arguments = parser.parse_args()
+    Handler.forum = Forum(arguments.posts)
+    Handler.delay = arguments.delay
+    print("Serving %s posts and %s comments on http://localhost:%s/graphql" %
+          (len(Handler.forum.posts), len(Handler.forum.comments), arguments.port), file=sys.stderr)
+    ThreadingHTTPServer(("127.0.0.1", arguments.port), Handler).serve_forever()
@@ -2,25 +2,18 @@
 
 import sys
 import datetime
-from urllib.parse import quote
 
 import config
 import util
 import linkpath
+import cache
+import queries
 
 
-def posts_list_query(view="new", offset=0, before="", after="", run_query=True):
-    query = ("""
-    {
+POSTS_LIST_QUERY = queries.Query("posts_list_query", """
+    query posts_list_query($terms: JSON) {
       posts(input: {
-        terms: {
-          view: "%s"
-          limit: 50
-          meta: null  # this seems to get both meta and non-meta posts
-          %s
-          %s
-          %s
-        }
+        terms: $terms
       }) {
         results {
           _id
@@ -42,28 +35,34 @@ def posts_list_query(view="new", offset=0, before="", after="", run_query=True):
         }
       }
     }
-    """ % (
-            view,
-            "offset: " + str(offset) if offset > 0 else "",
-            ('before: "%s"' % before) if before else "",
-            ('after: "%s"' % after) if after else ""
-        )
-    )
+    """)
+
+
+def posts_list_query(view="new", offset=0, before="", after="", run_query=True):
+    # meta: null seems to get both meta and non-meta posts
+    terms = {"view": view, "limit": 50, "meta": None}
+    if offset > 0:
+        terms["offset"] = offset
+    if before:
+        terms["before"] = before
+    if after:
+        terms["after"] = after
+    variables = {"terms": terms}
 
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return POSTS_LIST_QUERY.show(variables)
 
-    request = util.send_query(query, operation_name="posts_list_query")
+    request = util.send_query(POSTS_LIST_QUERY, variables)
     return util.get_from_request(request, ['data', 'posts', 'results'])
 
 
-def recent_comments_query(run_query=True):
-    query = ("""
-    {
+RECENT_COMMENTS_QUERY = queries.Query("recent_comments_query", """
+    query recent_comments_query($limit: Int, $offset: Int) {
       comments(input: {
         terms: {
           view: "recentComments"
-          limit: 10
+          limit: $limit
+          offset: $offset
         }
       }) {
         results {
@@ -82,44 +81,59 @@ def recent_comments_query(run_query=True):
           htmlBody
           postId
           pageUrl
+          postedAt
         }
       }
     }
     """)
 
+
+def recent_comments_query(run_query=True, limit=10, offset=0):
+    variables = {"limit": limit, "offset": offset}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return RECENT_COMMENTS_QUERY.show(variables)
 
-    request = util.send_query(query, operation_name="recent_comments_query")
+    request = util.send_query(RECENT_COMMENTS_QUERY, variables)
     return util.get_from_request(request, ['data', 'comments', 'results'])
 
 
-def show_daily_posts(offset, view, before, after, display_format):
-    posts_and_status_code = posts_list_query(offset=offset, view=view, before=before, after=after,
-                                          run_query=(False if display_format == "queries" else True))
-    if isinstance(posts_and_status_code, str):
-        posts = posts_and_status_code
-    else:
-        posts, status_code = posts_and_status_code
-        if status_code != 200:
-            return util.error_message_string("index", "", status_code)
+# The first year shown in the archive sidebar
+ARCHIVE_START_YEAR = 2006 if "lesswrong" in config.GRAPHQL_URL else 2011
 
-    recent_comments_and_status_code = recent_comments_query(run_query=(False if display_format == "queries" else True))
-    if isinstance(recent_comments_and_status_code, str):
-        recent_comments = recent_comments_and_status_code
-    else:
-        recent_comments, status_code = recent_comments_and_status_code
-        if status_code != 200:
-            return util.error_message_string("index", "", status_code)
+
+def archive_months(year):
+    """The months of year as they are linked from the archive sidebar: a list
+    of tuples (after, before, month name), with after the first day of the
+    month and before the last."""
+    months = []
+    for month in range(1, 12 + 1):
+        if month == 12:
+            last_day = datetime.date(year + 1, 1, 1) - datetime.timedelta(days=1)
+        else:
+            last_day = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+        months.append((str(year) + "-" + str(month).zfill(2) + "-01",
+                       last_day.strftime("%Y-%m-%d"),
+                       datetime.date(2000, month, 1).strftime("%B")))
+    return months
+
+
+def show_daily_posts(offset, view, before, after, display_format):
+    run_query = False if display_format == "queries" else True
+    posts_future, recent_comments_future = util.start_concurrently(
+        lambda: posts_list_query(offset=offset, view=view, before=before, after=after, run_query=run_query),
+        lambda: recent_comments_query(run_query=run_query))
 
     if display_format == "queries":
         result = "<pre>"
-        result += posts + "\n"  # this is just the query string
-        result += recent_comments + "\n"
+        result += posts_future.result() + "\n"  # this is just the query string
+        result += recent_comments_future.result() + "\n"
         result += "</pre>\n"
 
-        return result
+        yield result
+        return
 
+    # Nothing up to the list of posts depends on the query results, so it can
+    # be sent while the queries are running
 
     result = """<!DOCTYPE html>
     <html>
@@ -132,6 +146,9 @@ def show_daily_posts(offset, view, before, after, display_format):
     result += '''<div id="wrapper">'''
     result += '''<div id="content">'''
     result += """<h1><a href="/">%s</a></h1>""" % config.TITLE
+    # What an error message needs after it to finish the page: the ends of
+    # #content (or #sidebar, whichever is open) and #wrapper
+    page_end = "</div>\n</div>\n</body>\n</html>\n"
 
     result += '''
         View:
@@ -177,6 +194,19 @@ def show_daily_posts(offset, view, before, after, display_format):
 
     result += '''<a href="/?view=%s&amp;offset=%s%s">next page (older posts) →</a>''' % (view, offset + 50, date_range_params)
     result += '''<br/><br/>\n'''
+    yield result
+    result = ""
+
+    posts, status_code = posts_future.result()
+    if status_code != 200:
+        cache.uncacheable_page()
+        yield util.error_message_string("index", "", status_code) + page_end
+        return
+
+    cache.tag_page(*["post:" + post['_id'] for post in posts])
+    cache.tag_page(*["user:" + util.safe_get(post, ['user', 'slug']) for post in posts
+                     if util.safe_get(post, ['user', 'slug'])])
+    cache.note_comment_counts({post['_id']: post['commentCount'] for post in posts})
 
     for post in posts:
         post_url = linkpath.posts(postid=post['_id'], postslug=post['slug'])
@@ -216,8 +246,7 @@ def show_daily_posts(offset, view, before, after, display_format):
             <h2>Archive</h2>
             <ul>
     '''
-    start_year = 2006 if "lesswrong" in config.GRAPHQL_URL else 2011
-    for year in range(start_year, datetime.datetime.now(datetime.UTC).year + 1):
+    for year in range(ARCHIVE_START_YEAR, datetime.datetime.now(datetime.UTC).year + 1):
         result += "<li>\n"
         result += '''<a href="/?view=%s&amp;before=%s&amp;after=%s">%s</a>''' % (
             view,
@@ -230,22 +259,26 @@ def show_daily_posts(offset, view, before, after, display_format):
             # year (or a month within this year), so show the months in the
             # sidebar so that we can go inside the months.
             result += "<ul>"
-            for month in range(1, 12 + 1):
-                if month == 12:
-                    last_day = datetime.date(year + 1, 1, 1) - datetime.timedelta(days=1)
-                else:
-                    last_day = datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
+            for month_after, month_before, month_name in archive_months(year):
                 result += '''<li><a href="/?view=%s&amp;before=%s&amp;after=%s">%s</a></li>''' % (
                     view,
-                    last_day.strftime("%Y-%m-%d"),
-                    str(year) + "-" + str(month).zfill(2) + "-01",
-                    datetime.date(2000, month, 1).strftime("%B")
+                    month_before,
+                    month_after,
+                    month_name
                 )
             result += "</ul>"
         result += "</li>\n"
     result += "</ul>"
 
     result += '''<h2>Recent comments</h2>'''
+    yield result
+    result = ""
+
+    recent_comments, status_code = recent_comments_future.result()
+    if status_code != 200:
+        cache.uncacheable_page()
+        yield util.error_message_string("index", "", status_code) + page_end
+        return
     for comment in recent_comments:
         post = comment['post']
         if post is None:
@@ -266,19 +299,21 @@ def show_daily_posts(offset, view, before, after, display_format):
         )
 
     result += "</div>"  # sidebar
+    result += util.stale_notice()
     result += """
     </div>
         </body>
     </html>
     """
 
-    return result
+    yield result
 
 
 if __name__ == "__main__":
     if len(sys.argv) != 5+1:
         print("Unexpected number of arguments")
     else:
-        print(show_daily_posts(offset=int(sys.argv[1]), view=sys.argv[2],
-                               before=sys.argv[3], after=sys.argv[4],
-                               display_format=sys.argv[5]))
+        util.print_chunks(cache.page("index", tuple(sys.argv[1:6]),
+                                     lambda: show_daily_posts(offset=int(sys.argv[1]), view=sys.argv[2],
+                                                              before=sys.argv[3], after=sys.argv[4],
+                                                              display_format=sys.argv[5])))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""Which post IDs and user slugs exist, for turning away requests for ones
+that don't without asking the API endpoint.
+
+Crawlers request a lot of made-up /posts.php?id=... and /users.php?id=... URLs.
+Responses saying that the post or user doesn't exist are cached (for
+cache.NEGATIVE_TTL seconds), but every new made-up ID still costs a query. In
+strict mode (KNOWN_IDS_STRICT in config.py) an ID is first checked against:
+
+- the form IDs and slugs take;
+- a Bloom filter of every post ID and user slug, built from a snapshot of the
+  whole site by running ./knownids.py build (e.g. daily from cron);
+- the post IDs and user slugs seen in responses since then, which covers posts
+  and users that are newer than the snapshot as soon as they show up on any
+  page (the front page, a comment thread...).
+
+An ID that fails these checks gets a "not found" page right away. Without a
+snapshot, or outside strict mode, every ID is looked up as usual, since a brand
+new post could otherwise be turned away."""
+
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+import config
+import cache
+import queries
+import util
+
+KNOWN_IDS_STRICT = getattr(config, "KNOWN_IDS_STRICT", False)
+KNOWN_IDS_PATH = getattr(config, "KNOWN_IDS_PATH",
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), "known_ids.bloom"))
+FALSE_POSITIVE_RATE = 0.001
+# Page size used when building the snapshot
+BUILD_BATCH_SIZE = 1000
+
+ID_FORMATS = {
+    "post": re.compile(r'^[a-zA-Z0-9]{17}$'),
+    "user": re.compile(r'^[a-zA-Z0-9_-]{1,100}$'),
+}
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+class BloomFilter(object):
+    def __init__(self, bit_count, hash_count, bits=None, created=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        bit_count = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        hash_count = max(int(round(bit_count / capacity * math.log(2))), 1)
+        return cls(bit_count, hash_count)
+
+    def _positions(self, item):
+        # Double hashing: the i-th position is h1 + i*h2
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def save(self, path):
+        header = json.dumps({"bit_count": self.bit_count, "hash_count": self.hash_count,
+                             "created": self.created})
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(header.encode("utf-8") + b"\n")
+            f.write(self.bits)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            bits = bytearray(f.read())
+        return cls(header["bit_count"], header["hash_count"], bits, header["created"])
+
+
+def _load_snapshot():
+    """Return the Bloom filter from KNOWN_IDS_PATH, reloading it if the file
+    has been rebuilt, or None if there is no snapshot."""
+    global _snapshot
+    with _snapshot_lock:
+        try:
+            mtime = os.stat(KNOWN_IDS_PATH).st_mtime
+        except OSError:
+            _snapshot = None
+            return None
+        if _snapshot is None or _snapshot[0] != mtime:
+            try:
+                _snapshot = (mtime, BloomFilter.load(KNOWN_IDS_PATH))
+            except (OSError, ValueError, KeyError):
+                _snapshot = None
+                return None
+        return _snapshot[1]
+
+
+def might_exist(kind, value):
+    """Return False if the post (kind "post") or user (kind "user") called
+    value certainly doesn't exist, as far as we can tell without asking the
+    API endpoint. Always True outside strict mode."""
+    if not KNOWN_IDS_STRICT:
+        return True
+    if not ID_FORMATS[kind].match(value):
+        return False
+    snapshot = _load_snapshot()
+    if snapshot is None:
+        return True
+    item = kind + ":" + value
+    return item in snapshot or cache.is_known_id(item)
+
+
+def _ids_in(data):
+    """The post IDs and user slugs in a response, as items for the filter."""
+    items = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            if value.get("slug") and ("username" in value or "displayName" in value):
+                items.add("user:" + value["slug"])
+            if value.get("_id") and "title" in value and "postedAt" in value:
+                items.add("post:" + value["_id"])
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return items
+
+
+def note_response(data):
+    """Remember the post IDs and user slugs in a (decoded) response from the
+    API endpoint, so that posts and users created after the snapshot aren't
+    turned away."""
+    if KNOWN_IDS_STRICT:
+        cache.add_known_ids(_ids_in(data))
+
+
+BUILD_QUERIES = {
+    "post": queries.Query("knownids_build", """
+        query knownids_build($limit: Int, $offset: Int) {
+          posts(input: {terms: {view: "new", limit: $limit, offset: $offset, meta: null}}) {
+            results { _id }
+          }
+        }
+    """),
+    "user": queries.Query("knownids_build", """
+        query knownids_build($limit: Int, $offset: Int) {
+          users(input: {terms: {view: "LWUsersAdmin", limit: $limit, offset: $offset}}) {
+            results { slug }
+          }
+        }
+    """),
+}
+
+
+def build(path=KNOWN_IDS_PATH):
+    """Fetch every post ID and user slug from the API endpoint and save them as
+    a Bloom filter at path."""
+    items = []
+    for kind, query in BUILD_QUERIES.items():
+        field = "_id" if kind == "post" else "slug"
+        offset = 0
+        while True:
+            request = util.send_query(query, {"limit": BUILD_BATCH_SIZE, "offset": offset})
+            results, status_code = util.get_from_request(request, ["data", kind + "s", "results"])
+            if status_code != 200:
+                raise RuntimeError("Received status code %s from the API endpoint" % status_code)
+            if not results:
+                break
+            items.extend(kind + ":" + result[field] for result in results if result.get(field))
+            offset += len(results)
+            print("%s %ss" % (offset, kind), file=sys.stderr)
+    bloom = BloomFilter.for_capacity(len(items))
+    for item in items:
+        bloom.add(item)
+    bloom.save(path)
+    return len(items)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["build"]:
+        print("Saved %s IDs to %s" % (build(), KNOWN_IDS_PATH))
+    else:
+        print("Usage: ./knownids.py build")
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+
+"""Local copy of posts, comments, users and tags, kept up to date by polling
+the API endpoint.
+
+With MIRROR_PATH set in config.py, the renderers look up posts, their comments
+and answers, users and tags here first, and only query the API endpoint for
+what isn't here, so most page views don't touch the network at all and the
+site keeps working while the forum is down or blocking us.
+
+The mirror is filled by running ./mirror.py sync (e.g. every few minutes from
+cron), which uses the same queries as the pages themselves:
+
+- posts_list_query (view "new") for posts newer than the last sync;
+- recent_comments_query for comments newer than the last sync, which tells
+  us which older posts have new comments;
+- get_content_for_post, get_comments_for_post, query_question_answers and
+  query_replies_to_answers to copy each of these posts in full, along with the
+  authors of its comments.
+
+Posts and comments are also added to a full-text index (SQLite FTS5) as they
+are copied, which search.py uses instead of Algolia with LOCAL_SEARCH set in
+config.py (see search).
+
+Each sync reaches back at least MIRROR_RESYNC_DAYS, so that edits to recent
+posts and comments are picked up too. Tags are copied once a day. Older posts
+are only copied again when they get new comments, so to keep edits, deletions
+and changes of score or karma from being shown forever, anything copied more
+than MIRROR_MAX_AGE seconds ago counts as not being in the mirror: it is
+fetched from the API endpoint as usual until the post is synced again."""
+
+import datetime
+import html
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+import config
+import util
+import queries
+import posts
+import index
+
+MIRROR_PATH = getattr(config, "MIRROR_PATH", None)
+MIRROR_RESYNC_DAYS = getattr(config, "MIRROR_RESYNC_DAYS", 3)
+MIRROR_MAX_AGE = getattr(config, "MIRROR_MAX_AGE", 24 * 60 * 60)
+TAGS_SYNC_INTERVAL = 24 * 60 * 60
+# Page size used for recent_comments_query and the tag list when syncing
+SYNC_PAGE_SIZE = 50
+
+_local = threading.local()
+# Set while syncing, so that the queries sent by sync go to the API endpoint
+# rather than being answered from the mirror
+_syncing = False
+
+
+def _connect():
+    """Return this thread's connection to the mirror database, opening it (and
+    creating the tables) if necessary."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(MIRROR_PATH, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS posts (_id TEXT PRIMARY KEY, postedAt TEXT, data TEXT, synced REAL)")
+    # kind is "comment", "answer" or "reply" (to the answer answerId);
+    # position is the order the comments came in from the API endpoint (e.g.
+    # top scores first for get_comments_for_post)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS comments (
+            _id TEXT,
+            postId TEXT,
+            kind TEXT,
+            answerId TEXT,
+            position INTEGER,
+            postedAt TEXT,
+            data TEXT,
+            PRIMARY KEY (_id, kind)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS comments_post ON comments (postId, kind, position)")
+    conn.execute("CREATE INDEX IF NOT EXISTS comments_answer ON comments (answerId, position)")
+    conn.execute("CREATE TABLE IF NOT EXISTS users (_id TEXT PRIMARY KEY, slug TEXT, data TEXT, synced REAL)")
+    if "synced" not in [row[1] for row in conn.execute("PRAGMA table_info(users)")]:
+        # Mirrors made before users had a sync time; their users will be
+        # fetched from the API endpoint until they are synced again
+        conn.execute("ALTER TABLE users ADD COLUMN synced REAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS tags (slug TEXT PRIMARY KEY, data TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)")
+    # The text of each post (kind "post") and comment (kind "comment", which
+    # includes answers and replies), for search. search_fts indexes it and is
+    # kept in step by the triggers.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_text (
+            rowid INTEGER PRIMARY KEY,
+            _id TEXT,
+            kind TEXT,
+            postId TEXT,
+            title TEXT,
+            body TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS search_text_post ON search_text (postId)")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+                title, body, content='search_text', content_rowid='rowid', tokenize='porter unicode61'
+            )
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS search_text_insert AFTER INSERT ON search_text BEGIN
+                INSERT INTO search_fts (rowid, title, body) VALUES (new.rowid, new.title, new.body);
+            END
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS search_text_delete AFTER DELETE ON search_text BEGIN
+                INSERT INTO search_fts (search_fts, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body);
+            END
+        """)
+    except sqlite3.OperationalError:
+        # This SQLite was built without FTS5, so there is no local search
+        pass
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def _read(query, args):
+    """Rows for query, or None if the mirror is off or can't be read (in which
+    case the caller goes to the API endpoint)."""
+    if MIRROR_PATH is None or _syncing:
+        return None
+    try:
+        return _connect().execute(query, args).fetchall()
+    except sqlite3.Error:
+        return None
+
+
+def _synced_since():
+    """Anything synced before this time is too old to be used (see
+    MIRROR_MAX_AGE)."""
+    return time.time() - MIRROR_MAX_AGE
+
+
+def post(postid):
+    """The post as returned by posts.get_content_for_post, or None if it isn't
+    in the mirror."""
+    rows = _read("SELECT data FROM posts WHERE _id = ? AND synced >= ?", (postid, _synced_since()))
+    return json.loads(rows[0][0]) if rows else None
+
+
+def _comments(postid, kind, order):
+    # Comments are copied along with their post, so they are only there (and
+    # no rows only means no comments) if the post is
+    if not _read("SELECT 1 FROM posts WHERE _id = ? AND synced >= ?", (postid, _synced_since())):
+        return None
+    rows = _read("SELECT data FROM comments WHERE postId = ? AND kind = ? ORDER BY " + order,
+                 (postid, kind))
+    if rows is None:
+        return None
+    return [json.loads(data) for (data,) in rows]
+
+
+def comments_for_post(postid, view):
+    """The comments on the post in the order of the given view (as for
+    posts.get_comments_for_post, but without their "user"), or None if the
+    post isn't in the mirror."""
+    return _comments(postid, "comment", "postedAt" if view == "postCommentsOld" else "position")
+
+
+def answers_for_post(postid):
+    """The answers to the question post (without their "user"), or None if
+    the post isn't in the mirror."""
+    return _comments(postid, "answer", "position")
+
+
+def replies_to_answers(answer_ids):
+    """A dict mapping each of answer_ids to its replies (as for
+    posts.query_replies_to_answers, but without their "user"), or None unless
+    all of the answers are in the mirror."""
+    answer_ids = list(answer_ids)
+    replies = {}
+    for i in range(0, len(answer_ids), 500):
+        batch = answer_ids[i:i + 500]
+        placeholders = ", ".join("?" * len(batch))
+        found = _read("SELECT comments._id FROM comments JOIN posts ON posts._id = comments.postId "
+                      "WHERE kind = 'answer' AND comments._id IN (%s) AND synced >= ?" % placeholders,
+                      batch + [_synced_since()])
+        if found is None or len(set(found)) < len(set(batch)):
+            return None
+        rows = _read("SELECT answerId, data FROM comments WHERE kind = 'reply' AND answerId IN (%s) "
+                     "ORDER BY position" % placeholders, batch)
+        if rows is None:
+            return None
+        for answer_id, data in rows:
+            replies.setdefault(answer_id, []).append(json.loads(data))
+    return {answer_id: replies.get(answer_id, []) for answer_id in answer_ids}
+
+
+def users(userids):
+    """A dict mapping each of the userids found in the mirror to the user."""
+    userids = list(userids)
+    found = {}
+    # SQLite limits the number of parameters in a statement
+    for i in range(0, len(userids), 500):
+        batch = userids[i:i + 500]
+        rows = _read("SELECT _id, data FROM users WHERE _id IN (%s) AND synced >= ?" % ", ".join("?" * len(batch)),
+                     batch + [_synced_since()])
+        found.update((userid, json.loads(data)) for userid, data in rows or [])
+    return found
+
+
+def tag(slug):
+    """The tag as returned by tag.get_content_for_tag, or None if it isn't in
+    the mirror."""
+    if not _read("SELECT 1 FROM state WHERE name = 'tags_synced' AND CAST(value AS REAL) >= ?",
+                 (_synced_since(),)):
+        return None
+    rows = _read("SELECT data FROM tags WHERE slug = ?", (slug,))
+    return json.loads(rows[0][0]) if rows else None
+
+
+# Marks around the matches in search snippets; search.py turns them into
+# highlighting once the snippet has been escaped
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+def _fts_query(string):
+    """Turn a search string (words, "quoted phrases" and -excluded words) into
+    an FTS5 query with every term quoted, so that nothing in it is taken as
+    FTS5 syntax. Returns None if there is nothing to search for."""
+    included = []
+    excluded = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', string):
+        exclude = not phrase and word.startswith("-")
+        words = (phrase or word.lstrip("-")).replace('"', " ").split()
+        if words:
+            (excluded if exclude else included).append('"%s"' % " ".join(words))
+    if not included:
+        return None
+    return " ".join(included) + "".join(" NOT " + term for term in excluded)
+
+
+def search(kind, string, page=0, hits_per_page=30):
+    """The posts (kind "post") or comments (kind "comment") in the mirror that
+    match string, best first (by BM25, with matches in a post's title counting
+    for more than matches in its body), in the same form as the Algolia hits
+    that search.py shows. Each hit also has a "_snippet": the part of the
+    body around the matches, with the matches between HIGHLIGHT_START and
+    HIGHLIGHT_END, or None if only the title matched. Returns None if the
+    mirror can't be searched."""
+    query = _fts_query(string)
+    if query is None:
+        return []
+    rows = _read("""
+        SELECT search_text._id, search_text.postId, snippet(search_fts, 1, ?, ?, " … ", 48)
+        FROM search_fts JOIN search_text ON search_text.rowid = search_fts.rowid
+        WHERE search_fts MATCH ? AND search_text.kind = ?
+        ORDER BY bm25(search_fts, 10.0, 1.0)
+        LIMIT ? OFFSET ?
+    """, (HIGHLIGHT_START, HIGHLIGHT_END, query, kind, hits_per_page, page * hits_per_page))
+    if rows is None:
+        return None
+
+    postids = list(set(postid for _, postid, _ in rows))
+    found_posts = dict((postid, json.loads(data)) for postid, data in
+                       _read("SELECT _id, data FROM posts WHERE _id IN (%s)" % ", ".join("?" * len(postids)),
+                             postids) or [])
+    if kind == "comment":
+        commentids = [commentid for commentid, _, _ in rows]
+        found_comments = dict((commentid, json.loads(data)) for commentid, data in
+                              _read("SELECT _id, data FROM comments WHERE _id IN (%s)"
+                                    % ", ".join("?" * len(commentids)), commentids) or [])
+        found_users = users(comment.get("userId") for comment in found_comments.values())
+
+    hits = []
+    for documentid, postid, snippet in rows:
+        post = found_posts.get(postid, {})
+        if kind == "post":
+            document = post
+            user = post.get("user") or {}
+        else:
+            document = found_comments.get(documentid, {})
+            user = found_users.get(document.get("userId")) or {}
+        hit = {
+            "_id": documentid,
+            "postId": postid,
+            "title": post.get("title", ""),
+            "postTitle": post.get("title", ""),
+            "slug": post.get("slug"),
+            "userId": document.get("userId") or user.get("_id"),
+            "postedAt": document.get("postedAt", ""),
+            "authorSlug": user.get("slug"),
+            "authorDisplayName": user.get("displayName"),
+            "_snippet": snippet if HIGHLIGHT_START in (snippet or "") else None,
+        }
+        if user.get("username"):
+            hit["authorUserName"] = user["username"]
+        hits.append(hit)
+    return hits
+
+
+def _write(function, *args):
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        function(conn, *args)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def state(name):
+    """The value saved under name by set_state (such as a sync watermark or a
+    backfill checkpoint), or None."""
+    row = _connect().execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (name, value))
+
+
+def set_state(name, value):
+    _write(_set_state, name, value)
+
+
+def _store_post(conn, post, comments, answers, replies):
+    conn.execute("INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?)",
+                 (post["_id"], post.get("postedAt"), json.dumps(post), time.time()))
+    conn.execute("DELETE FROM comments WHERE postId = ?", (post["_id"],))
+    lists = [("comment", None, comments), ("answer", None, answers)]
+    lists += [("reply", answer_id, documents) for answer_id, documents in replies.items()]
+    for kind, answer_id, documents in lists:
+        for position, document in enumerate(documents):
+            user = document.pop("user", None)
+            if user and user.get("_id"):
+                conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)",
+                             (user["_id"], user.get("slug"), json.dumps(user), time.time()))
+            conn.execute("INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (document["_id"], post["_id"], kind, answer_id, position,
+                          document.get("postedAt"), json.dumps(document)))
+    indexed = {}
+    for _, _, documents in lists:
+        indexed.update((document["_id"], document) for document in documents)
+    _index_post(conn, post, list(indexed.values()))
+
+
+def _delete_post(conn, postid):
+    conn.execute("DELETE FROM posts WHERE _id = ?", (postid,))
+    conn.execute("DELETE FROM comments WHERE postId = ?", (postid,))
+    conn.execute("DELETE FROM search_text WHERE postId = ?", (postid,))
+
+
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def _text(html_body):
+    """The text of an HTML body, for the search index."""
+    return " ".join(html.unescape(TAG_RE.sub(" ", html_body or "")).split())
+
+
+def _index_post(conn, post, comments):
+    conn.execute("DELETE FROM search_text WHERE postId = ?", (post["_id"],))
+    conn.execute("INSERT INTO search_text (_id, kind, postId, title, body) VALUES (?, 'post', ?, ?, ?)",
+                 (post["_id"], post["_id"], post.get("title") or "", _text(post.get("htmlBody"))))
+    conn.executemany("INSERT INTO search_text (_id, kind, postId, title, body) VALUES (?, 'comment', ?, '', ?)",
+                     [(comment["_id"], post["_id"], _text(comment.get("htmlBody"))) for comment in comments])
+
+
+def sync_post(postid):
+    """Copy the post, its comments, answers and replies to answers, and their
+    authors into the mirror. Returns False if the API endpoint couldn't be queried."""
+    post, status_code = posts.get_content_for_post(postid)
+    if status_code != 200:
+        return False
+    if post is None:
+        # The post has been deleted
+        _write(_delete_post, postid)
+        return True
+    comments = posts.get_comments_for_post(postid)
+    answers = posts.query_question_answers(postid) if post.get("question") else []
+    if isinstance(comments, str) or isinstance(answers, str):
+        return False
+    replies, status_code = posts.query_replies_to_answers([answer["_id"] for answer in answers])
+    if status_code != 200:
+        return False
+    _write(_store_post, post, comments, answers, replies)
+    return True
+
+
+def sync_posts(postids, progress=False):
+    """Sync each of postids, PAGE_CONCURRENCY at a time. Returns the number
+    of posts that couldn't be synced."""
+    failed = 0
+    for i in range(0, len(postids), util.PAGE_CONCURRENCY):
+        batch = postids[i:i + util.PAGE_CONCURRENCY]
+        results = util.run_concurrently(*[lambda postid=postid: sync_post(postid) for postid in batch])
+        failed += results.count(False)
+        if progress:
+            print("%s/%s posts" % (i + len(batch), len(postids)), file=sys.stderr)
+    return failed
+
+
+def _newer_than(fetch, cutoff):
+    """Page through a list that is sorted newest first (fetch(offset) returns
+    a tuple (page, status code)), collecting everything posted after cutoff."""
+    items = []
+    offset = 0
+    while True:
+        page, status_code = fetch(offset)
+        if status_code != 200:
+            raise RuntimeError("Received status code %s from the API endpoint" % status_code)
+        if not page:
+            return items
+        for item in page:
+            if (item.get("postedAt") or "") < cutoff:
+                return items
+            items.append(item)
+        offset += len(page)
+
+
+TAG_LIST_QUERY = queries.Query("mirror_tags", """
+    query mirror_tags($limit: Int, $offset: Int) {
+      tags(input: {terms: {view: "allTagsAlphabetical", limit: $limit, offset: $offset}}) {
+        results {
+          _id
+          slug
+          description {
+            html
+          }
+        }
+      }
+    }
+    """)
+
+
+def _store_tags(conn, tags):
+    for tag in tags:
+        if tag.get("slug"):
+            conn.execute("INSERT OR REPLACE INTO tags VALUES (?, ?)", (tag["slug"], json.dumps(tag)))
+    _set_state(conn, "tags_synced", str(time.time()))
+
+
+def sync():
+    """Bring the mirror up to date. Returns the number of posts synced."""
+    global _syncing
+    _syncing = True
+    # A cached response could be older than the watermarks
+    util.skip_response_cache()
+    resync_cutoff = (datetime.datetime.now(datetime.timezone.utc)
+                     - datetime.timedelta(days=MIRROR_RESYNC_DAYS)).strftime("%Y-%m-%dT%H:%M:%S")
+    posts_cutoff = min(state("posts_watermark") or resync_cutoff, resync_cutoff)
+    comments_cutoff = min(state("comments_watermark") or resync_cutoff, resync_cutoff)
+
+    new_posts = _newer_than(lambda offset: index.posts_list_query(view="new", offset=offset),
+                            posts_cutoff)
+    new_comments = _newer_than(lambda offset: index.recent_comments_query(limit=SYNC_PAGE_SIZE, offset=offset),
+                               comments_cutoff)
+    print("%s new posts, %s new comments" % (len(new_posts), len(new_comments)), file=sys.stderr)
+
+    postids = sorted(set([post["_id"] for post in new_posts] +
+                         [comment["postId"] for comment in new_comments if comment.get("postId")]))
+    failed = sync_posts(postids, progress=True)
+
+    if failed:
+        # Leave the watermarks where they are, so that the next sync tries
+        # these posts again
+        print("%s posts could not be synced" % failed, file=sys.stderr)
+    else:
+        def advance_watermarks(conn):
+            for name, items in (("posts_watermark", new_posts), ("comments_watermark", new_comments)):
+                newest = max([item.get("postedAt") or "" for item in items] + [state(name) or ""])
+                if newest:
+                    _set_state(conn, name, newest)
+        _write(advance_watermarks)
+
+    # Often enough that the tags never get older than MIRROR_MAX_AGE between
+    # syncs
+    if time.time() - float(state("tags_synced") or 0) > min(TAGS_SYNC_INTERVAL, MIRROR_MAX_AGE / 2):
+        tags, status_code = util.fetch_all_pages(TAG_LIST_QUERY, {}, ["data", "tags", "results"],
+                                                 SYNC_PAGE_SIZE)
+        if status_code == 200:
+            _write(_store_tags, tags)
+            print("%s tags" % len(tags), file=sys.stderr)
+    return len(postids) - failed
+
+
+def _reindex(conn):
+    conn.execute("DELETE FROM search_text")
+    for postid, data in conn.execute("SELECT _id, data FROM posts").fetchall():
+        comments = dict((commentid, json.loads(comment)) for commentid, comment in
+                        conn.execute("SELECT _id, data FROM comments WHERE postId = ?", (postid,)))
+        _index_post(conn, json.loads(data), list(comments.values()))
+    conn.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+
+
+def reindex():
+    """Rebuild the search index from the posts and comments in the mirror (for
+    mirrors made before there was one)."""
+    _write(_reindex)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] not in (["sync"], ["reindex"]):
+        print("Usage: ./mirror.py sync|reindex")
+    elif MIRROR_PATH is None:
+        print("Set MIRROR_PATH in config.py first")
+    else:
+        with open(MIRROR_PATH + ".lock", "w") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    sys.exit("Another sync is already running")
+            if sys.argv[1] == "reindex":
+                reindex()
+                print("Rebuilt the search index")
+            else:
+                print("Synced %s posts" % sync())
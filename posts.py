@@ -1,22 +1,25 @@
 #!/usr/bin/env python3
 
 import sys
-from urllib.parse import quote
 import datetime
+import functools
 from typing import Any
 
 import config
 import util
 import linkpath
+import cache
+import knownids
+import mirror
+import queries
 
 
-def get_content_for_post(postid, run_query=True) -> tuple[Any, int] | str:
-    query = ("""
-    {
+GET_CONTENT_FOR_POST = queries.Query("get_content_for_post", """
+    query get_content_for_post($postId: String) {
       post(
         input: {
           selector: {
-            _id: "%s"
+            _id: $postId
           }
         }
       ) {
@@ -50,149 +53,212 @@ def get_content_for_post(postid, run_query=True) -> tuple[Any, int] | str:
         }
       }
     }
-    """ % postid)
+    """)
+
 
+def get_content_for_post(postid, run_query=True) -> tuple[Any, int] | str:
+    variables = {"postId": postid}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return GET_CONTENT_FOR_POST.show(variables)
 
-    request = util.send_query(query, operation_name="get_content_for_post")
+    post = mirror.post(postid)
+    if post is not None:
+        return (post, 200)
+    request = util.send_query(GET_CONTENT_FOR_POST, variables)
     return util.get_from_request(request, ['data', 'post', 'result'])
 
 
-def get_comments_for_post(postid, view="postCommentsTop", run_query=True):
-    query = ("""
-    {
+GET_COMMENTS_FOR_POST = queries.Query("get_comments_for_post", """
+    query get_comments_for_post($view: String, $postId: String, $limit: Int, $offset: Int, $withUsers: Boolean!) {
       comments(input: {
         terms: {
-          view: "%s",
-          postId: "%s",
+          view: $view,
+          postId: $postId,
+          limit: $limit,
+          offset: $offset,
         }
       }) {
         results {
           _id
-          user {
-            _id
-            username
-            displayName
-            slug
-            bio
-          }
-          userId
-          author
+          userId @include(if: $withUsers)
           parentCommentId
           pageUrl
           htmlBody
-          baseScore
-          voteCount
           postedAt
         }
       }
     }
-    """ % (view, postid))
+    """)
+
+
+# Number of comments fetched per request by get_comments_for_post
+COMMENTS_PAGE_SIZE = 500
 
+
+def get_comments_for_post(postid, view="postCommentsTop", run_query=True, with_users=True):
+    """All of the comments on a post, fetched COMMENTS_PAGE_SIZE at a time by
+    util.fetch_all_pages. Their authors are joined in with util.join_users,
+    unless with_users is False (for pages such as chan.py that don't show
+    them)."""
+    variables = {"view": view, "postId": postid, "withUsers": with_users}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return (GET_COMMENTS_FOR_POST.show(dict(variables, limit=COMMENTS_PAGE_SIZE, offset=0)) +
+                (util.query_users([], run_query=False) if with_users else ""))
 
-    request = util.send_query(query, operation_name="get_comments_for_post")
+    result = mirror.comments_for_post(postid, view)
+    if result is not None:
+        return util.join_users(result) if with_users else result
     result = []
     assert run_query
-    comments, status_code = util.get_from_request(request, ['data', 'comments', 'results'])
+    comments, status_code = util.fetch_all_pages(GET_COMMENTS_FOR_POST, variables,
+                                                 ['data', 'comments', 'results'], COMMENTS_PAGE_SIZE)
     if status_code != 200:
         return util.error_message_string("posts", postid, status_code)
     for comment in comments:
         result.append(comment)
 
+    if with_users:
+        util.join_users(result)
     return result
 
 
-def query_question_answers(postid, run_query=True):
-    query = ("""
-    {
+QUERY_QUESTION_ANSWERS = queries.Query("query_question_answers", """
+    query query_question_answers($postId: String) {
       comments(input: {
         terms: {
           view: "questionAnswers",
-          postId: "%s",
+          postId: $postId,
         }
       }) {
         results {
           _id
-          user {
-            _id
-            username
-            displayName
-            slug
-            bio
-          }
           userId
           author
-          parentCommentId
           pageUrl
           htmlBody
-          baseScore
-          voteCount
           postedAt
-          answer
         }
       }
     }
-    """ % postid)
+    """)
+
 
+def query_question_answers(postid, run_query=True):
+    variables = {"postId": postid}
     if not run_query:
-        query_url = config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % query_url)
+        return QUERY_QUESTION_ANSWERS.show(variables) + util.query_users([], run_query=False)
 
-    request = util.send_query(query, operation_name="query_question_answers")
+    answers = mirror.answers_for_post(postid)
+    if answers is not None:
+        return util.join_users(answers)
+    request = util.send_query(QUERY_QUESTION_ANSWERS, variables)
     result = []
     answers, status_code = util.get_from_request(request, ['data', 'comments', 'results'])
     if status_code != 200:
         return util.error_message_string("posts", postid, status_code)
     for answer in answers:
         result.append(answer)
-    return result
+    return util.join_users(result)
 
 
-def query_replies_to_answer(answer_id, run_query=True):
-    query = ("""
-    {
-      comments(input: {
-        terms: {
-          view: "repliesToAnswer",
-          parentAnswerId: "%s",
-        }
-      }) {
+REPLY_FIELDS = """
         results {
           _id
-          user {
-            _id
-            username
-            displayName
-            slug
-          }
           userId
-          author
           parentCommentId
           pageUrl
-          baseScore
-          voteCount
           postedAt
           htmlBody
+        }"""
+
+QUERY_REPLIES_TO_ANSWER = queries.Query("query_replies_to_answer", """
+    query query_replies_to_answer($answerId: String) {
+      comments(input: {
+        terms: {
+          view: "repliesToAnswer",
+          parentAnswerId: $answerId,
         }
+      }) {%s
       }
     }
-    """ % answer_id)
+    """ % REPLY_FIELDS)
 
+
+def query_replies_to_answer(answer_id, run_query=True):
+    variables = {"answerId": answer_id}
     if not run_query:
-        query_url = config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % query_url)
+        return QUERY_REPLIES_TO_ANSWER.show(variables)
 
-    request = util.send_query(query, operation_name="query_replies_to_answer")
+    request = util.send_query(QUERY_REPLIES_TO_ANSWER, variables)
     result = []
     comments, status_code = util.get_from_request(request, ['data', 'comments', 'results'])
     if status_code != 200:
         return util.error_message_string("posts", answer_id, status_code)
     for comment in comments:
         result.append(comment)
-    return result
+    return util.join_users(result)
+
+
+# Number of answers whose replies are fetched in a single request by
+# query_replies_to_answers. Each batch is one aliased GraphQL query; batches are
+# sent concurrently.
+REPLIES_BATCH_SIZE = 20
+
+
+@functools.lru_cache(maxsize=None)
+def replies_to_answers_query(count):
+    """The query for the replies to count answers, with the replies to the i-th
+    answer (variable $answer<i>) under the alias answer<i>. There is one
+    document per batch size, built the first time it is needed."""
+    parts = []
+    for i in range(count):
+        parts.append("""
+      answer%s: comments(input: {
+        terms: {
+          view: "repliesToAnswer",
+          parentAnswerId: $answer%s,
+        }
+      }) {%s
+      }""" % (i, i, REPLY_FIELDS))
+    arguments = ", ".join("$answer%s: String" % i for i in range(count))
+    return queries.Query("query_replies_to_answers", "\n    query query_replies_to_answers(%s) {%s\n    }\n    " % (arguments, "".join(parts)))
+
+
+def query_replies_to_answers(answer_ids, run_query=True):
+    """Fetch the replies to every answer in answer_ids, using one aliased
+    GraphQL query per REPLIES_BATCH_SIZE answers rather than one query per
+    answer. Returns a tuple (dict mapping answer ID to list of replies, status
+    code)."""
+    batches = [answer_ids[i:i + REPLIES_BATCH_SIZE]
+               for i in range(0, len(answer_ids), REPLIES_BATCH_SIZE)]
+
+    def batch_variables(batch):
+        return {"answer%s" % i: answer_id for i, answer_id in enumerate(batch)}
+
+    if not run_query:
+        result = ""
+        for batch in batches:
+            result += replies_to_answers_query(len(batch)).show(batch_variables(batch))
+        return result
+
+    mirrored = mirror.replies_to_answers(answer_ids)
+    if mirrored is not None:
+        util.join_users([reply for answer_replies in mirrored.values() for reply in answer_replies])
+        return (mirrored, 200)
+
+    def fetch(batch):
+        request = util.send_query(replies_to_answers_query(len(batch)), batch_variables(batch))
+        return util.get_from_request(request, ['data'])
+
+    replies: dict[str, list] = {}
+    results = util.run_concurrently(*[lambda batch=batch: fetch(batch) for batch in batches])
+    for batch, (data, status_code) in zip(batches, results):
+        if status_code != 200:
+            return (replies, status_code)
+        for i, answer_id in enumerate(batch):
+            replies[answer_id] = util.safe_get(data, ["answer%s" % i, "results"], default=[])
+    util.join_users([reply for batch_replies in replies.values() for reply in batch_replies])
+    return (replies, 200)
 
 
 class CommentTree(object):
@@ -238,61 +304,96 @@ def build_comment_thread(comments):
                 # https://web.archive.org/web/20160824012747/http://effective-altruism.com/ea/10l/june_2016_givewell_board_meeting/
                 root.insert(node)
 
-    update_parity(root, "even")
-
     return root
 
 
-def update_parity(comment_node, parity):
-    comment_node.parity = parity
-    for child in comment_node.children:
-        child_parity = "even" if parity == "odd" else "odd"
-        update_parity(child, child_parity)
-
-
 def show_comment(comment_node):
+    return "".join(render_comment(comment_node))
+
+
+def render_comment(comment_node):
+    """Generate the HTML for comment_node and all of its replies, one comment
+    at a time, so that a page can be sent out while it is being rendered.
+
+    The tree is walked with an explicit stack instead of recursion: each node
+    is pushed once to open it and once more to close its <details> and <div>
+    after all of its replies, so the time taken is linear in the number of
+    comments however deep the thread is. Each comment's parity (which sets
+    its background color) is the opposite of its parent's, and is set as it
+    is pushed."""
+    if comment_node.parity is None:
+        comment_node.parity = "even"
+    stack = [(comment_node, False)]
+    while stack:
+        node, closing = stack.pop()
+        if closing:
+            yield "</details></div>"
+            continue
+        # If this is the root node, data is {} so there is nothing to show
+        if node.data:
+            yield show_comment_header(node)
+            stack.append((node, True))
+        child_parity = "even" if node.parity == "odd" else "odd"
+        for child in reversed(node.children):
+            child.parity = child_parity
+            stack.append((child, False))
+
+
+def show_comment_header(comment_node):
+    """The HTML for a single comment, up to (but not including) its replies
+    and closing tags."""
     result = ""
     comment = comment_node.data
     color = config.COMMENT_COLOR if comment_node.parity == "odd" else "#FFFFFF"
+    commentid = comment['_id']
+    result += ('''<div id="%s" style="border: 1px solid #B3B3B3; padding-left: 15px; padding-right: 0px; padding-bottom: 10px; padding-top: 10px; margin-left: 0px; margin-right: -1px; margin-bottom: 0px; margin-top: 10px; background-color: %s">''' % (commentid, color))
+    result += cache.fragment("comment", comment, lambda: show_comment_body(comment),
+                             extra=comment_fragment_fields(comment))
+    if comment_node.children:
+        result += '<span style="font-size: 14px;">Replies from: '
+        replies = ['<a href="#%s">%s</a>' %
+                   (child.commentid, util.safe_get(child.data, ['user', 'username']))
+                   for child in comment_node.children]
+        result += ", ".join(replies)
+        result += '</span>'
+    return result
 
-    # If this is the root node, comment is {} so skip it
-    if comment:
-        commentid = comment['_id']
-        result += ('''<div id="%s" style="border: 1px solid #B3B3B3; padding-left: 15px; padding-right: 0px; padding-bottom: 10px; padding-top: 10px; margin-left: 0px; margin-right: -1px; margin-bottom: 0px; margin-top: 10px; background-color: %s">''' % (commentid, color))
-        result += "<details open>"
-        result += "<summary>"
-        if util.safe_get(comment, 'parentCommentId'):
-            result += '''<a href="#%s" title="Go to parent comment">↑</a> ''' % util.safe_get(comment, 'parentCommentId')
-        result += "comment by "
-        result += util.userlink(slug=util.safe_get(comment, ['user', 'slug']),
-                                username=util.safe_get(comment, ['user', 'username']),
-                                display_name=util.safe_get(comment, ['user', 'displayName']),
-                                bio=util.safe_get(comment, ['user', 'bio']))
-        result += " ·\n"
-        result += (('''<a href="#%s">''' % commentid) + comment['postedAt'] + "</a> · ")
-        result += util.grouped_links(util.alt_urls(comment['pageUrl']))
-        result += "</summary>"
-        result += util.cleanHtmlBody(util.substitute_alt_links(comment['htmlBody']))
-        if comment_node.children:
-            result += '<span style="font-size: 14px;">Replies from: '
-            replies = ['<a href="#%s">%s</a>' %
-                       (child.commentid, util.safe_get(child.data, ['user', 'username']))
-                       for child in comment_node.children]
-            result += ", ".join(replies)
-            result += '</span>'
 
-    if comment_node.children:
-        for child in comment_node.children:
-            result += show_comment(child)
+def comment_fragment_fields(comment):
+    """Everything besides htmlBody and baseScore that show_comment_body uses."""
+    return (comment.get('parentCommentId'), comment['postedAt'], comment['pageUrl'],
+            util.safe_get(comment, ['user', 'slug']),
+            util.safe_get(comment, ['user', 'username']),
+            util.safe_get(comment, ['user', 'displayName']),
+            util.safe_get(comment, ['user', 'bio']))
 
-    if comment:
-        result += "</details>"
-        result += "</div>"
 
+def show_comment_body(comment):
+    """The part of a comment that doesn't depend on where it is in the
+    thread: its summary line and its body."""
+    result = ""
+    commentid = comment['_id']
+    result += "<details open>"
+    result += "<summary>"
+    if util.safe_get(comment, 'parentCommentId'):
+        result += '''<a href="#%s" title="Go to parent comment">↑</a> ''' % util.safe_get(comment, 'parentCommentId')
+    result += "comment by "
+    result += util.userlink(slug=util.safe_get(comment, ['user', 'slug']),
+                            username=util.safe_get(comment, ['user', 'username']),
+                            display_name=util.safe_get(comment, ['user', 'displayName']),
+                            bio=util.safe_get(comment, ['user', 'bio']))
+    result += " ·\n"
+    result += (('''<a href="#%s">''' % commentid) + comment['postedAt'] + "</a> · ")
+    result += util.grouped_links(util.alt_urls(comment['pageUrl']))
+    result += "</summary>"
+    result += util.clean_html_body(comment['htmlBody'])
     return result
 
 
-def show_answer(answer):
+def show_answer(answer, replies=None):
+    """Render an answer along with its replies. If replies is None, the replies
+    are fetched here; pages that show many answers should instead fetch all
+    replies up front with query_replies_to_answers and pass them in."""
     result = ("""
     <div id="%s" style="border: 1px solid #B3B3B3; padding-left: 15px; padding-right: 0px; padding-bottom: 10px; padding-top: 10px; margin-left: 0px; margin-right: -1px; margin-bottom: 0px; margin-top: 10px;">
         answer by %s · <a href="#%s">%s</a> · %s
@@ -307,9 +408,10 @@ def show_answer(answer):
         answer["_id"],
         answer["postedAt"],
         util.grouped_links(util.alt_urls(util.safe_get(answer, "pageUrl"), is_answer=True)),
-        util.cleanHtmlBody(util.substitute_alt_links(answer["htmlBody"])),
+        util.clean_html_body(answer["htmlBody"]),
     ))
-    replies = query_replies_to_answer(util.safe_get(answer, "_id"))
+    if replies is None:
+        replies = query_replies_to_answer(util.safe_get(answer, "_id"))
     root = build_comment_thread(replies)
     result += show_comment(root)
     result += "</div>"
@@ -318,18 +420,50 @@ def show_answer(answer):
 
 
 def show_post_and_comment_thread(postid, display_format):
-    print("""<!DOCTYPE html>
+    result = """<!DOCTYPE html>
     <html>
-    """)
+    """
     run_query = False if display_format == "queries" else True
+    if run_query and not knownids.might_exist("post", postid):
+        # Not cached, as the ID can become known at any time (see knownids)
+        cache.uncacheable_page()
+        yield util.error_page("posts", postid, 404)
+        return
+
+    # Which comment view we want depends on the post date, and whether we need
+    # the answers depends on whether the post is a question. Rather than wait
+    # for the post before sending the other queries, we fetch everything we
+    # might need at the same time and throw away what we don't use.
+    fetch_old_comments = run_query and "lesswrong" in config.GRAPHQL_URL
+    calls = [
+        lambda: get_content_for_post(postid, run_query=run_query),
+        lambda: get_comments_for_post(postid, run_query=run_query),
+        lambda: query_question_answers(postid, run_query=run_query),
+    ]
+    if fetch_old_comments:
+        calls.append(lambda: get_comments_for_post(postid, view="postCommentsOld", run_query=run_query))
+    futures = util.start_concurrently(*calls)
+
+    # Send everything that doesn't depend on the post while the queries run
+    if run_query:
+        result += util.show_head_start()
+    yield result
+    result = ""
+
+    post_and_status_code, top_comments, all_answers, *old_comments = [future.result() for future in futures]
 
-    post_and_status_code = get_content_for_post(postid, run_query=run_query)
     if isinstance(post_and_status_code, str):
         post = post_and_status_code
     else:
         post, status_code = post_and_status_code
+        if status_code == 200 and post is None:
+            # The API (or a cached "not found" response) says there is no
+            # such post
+            status_code = 404
         if status_code != 200:
-            return util.error_message_string("posts", postid, status_code)
+            cache.uncacheable_page()
+            yield util.error_page("posts", postid, status_code, head_started=True)
+            return
 
     if run_query:
         post_date = util.safe_get(post, 'postedAt', default="2018-01-01")
@@ -338,38 +472,49 @@ def show_post_and_comment_thread(postid, display_format):
     # Apparently post_date is sometimes the empty string, so we have to check again
     if not post_date:
         post_date = "2018-01-01"
-    if (run_query and "lesswrong" in config.GRAPHQL_URL and
+    if (fetch_old_comments and
         datetime.datetime.strptime(post_date[:len("2018-01-01")],
                                    "%Y-%m-%d") < datetime.datetime(2009, 2, 27)):
-        comments = get_comments_for_post(postid, view="postCommentsOld", run_query=run_query)
+        comments = old_comments[0]
         sorting_text = "oldest first, as this post is from before comment nesting was available (around 2009-02-27)."
     else:
-        comments = get_comments_for_post(postid, run_query=run_query)
+        comments = top_comments
         sorting_text = "top scores."
     if (not run_query) or util.safe_get(post, "question"):
-        answers = query_question_answers(postid, run_query=run_query)
+        answers = all_answers
 
     if display_format == "queries":
-        result = "<pre>"
+        result += "<pre>"
         result += post + "\n"
         result += comments + "\n"
         result += answers + "\n"
         result += "</pre>\n"
-        return result
+        yield result
+        return
 
     if "user" in post and post["user"] and "slug" in post["user"] and post["user"]["slug"]:
         author = post['user']['slug']
     else:
         author = None
+
+    # Tell the page cache which posts and users this page shows, and purge
+    # other cached pages of this post if it has new comments
+    people = [post.get("user")] + util.safe_get(post, "coauthors", [])
+    if isinstance(comments, list):
+        people += [comment.get("user") for comment in comments]
+    cache.tag_page("post:" + postid, *set("user:" + person["slug"] for person in people
+                                          if person and person.get("slug")))
+    cache.note_comment_counts({postid: post['commentCount']})
+
     canonical_url = util.safe_get(post, 'pageUrl')
     if util.safe_get(post, 'canonicalSource'):
         canonical_url = util.safe_get(post, 'canonicalSource')
-    result = util.show_head(title=post['title'],
-                            canonical_url=canonical_url,
-                            author=author if author is not None else "[deleted]",
-                            date=post['postedAt'],
-                            publisher="LessWrong 2.0" if "lesswrong" in config.GRAPHQL_URL
-                                       else "Effective Altruism Forum")
+    result += util.show_head_end(title=post['title'],
+                                 canonical_url=canonical_url,
+                                 author=author if author is not None else "[deleted]",
+                                 date=post['postedAt'],
+                                 publisher="LessWrong 2.0" if "lesswrong" in config.GRAPHQL_URL
+                                            else "Effective Altruism Forum")
     result += "<body>\n"
     result += util.show_navbar(navlinks=[
             '''<a href="%s" title="Show all the GraphQL queries used to generate this page">Queries</a>''' % linkpath.posts(postid=util.htmlescape(postid), postslug=post['slug'], display_format="queries")
@@ -425,14 +570,20 @@ def show_post_and_comment_thread(postid, display_format):
             # post['htmlBody'] is HTML without the table of contents anchors added
             # in, so we have to use a separate HTML provided by the
             # tableOfContents JSON
-            result += util.cleanHtmlBody(util.substitute_alt_links(util.safe_get(post, ['tableOfContents', 'html'])))
+            result += util.clean_html_body(util.safe_get(post, ['tableOfContents', 'html']))
     else:
-        result += util.cleanHtmlBody(util.substitute_alt_links(post['htmlBody']))
+        result += util.clean_html_body(post['htmlBody'])
+    yield result
+    result = ""
 
     if util.safe_get(post, "question"):
-        result += '<h2 id="answers">Answers</h2>'
+        yield '<h2 id="answers">Answers</h2>'
+        replies_by_answer, status_code = query_replies_to_answers([answer["_id"] for answer in answers])
+        if status_code != 200:
+            cache.uncacheable_page()
+            yield util.error_message_string("posts", postid, status_code)
         for answer in answers:
-            result += show_answer(answer)
+            yield show_answer(answer, replies=replies_by_answer.get(answer["_id"], []))
 
     if util.safe_get(post, "question") and util.safe_get(post, ["tableOfContents", "sections"]):
         result += '''<h2 id="comments">''' + util.safe_get(post, ["tableOfContents", "sections"])[-1]["title"] + '</h2>\n'
@@ -440,22 +591,24 @@ def show_post_and_comment_thread(postid, display_format):
         result += '''<h2 id="comments">''' + str(post['commentCount']) + ' comments</h2>'
     result += "<p>Comments sorted by %s</p>" % sorting_text
 
+    yield result
+
     root = build_comment_thread(comments)
-    result += show_comment(root)
+    yield from render_comment(root)
 
-    result += ("""
+    yield util.stale_notice()
+    yield ("""
     </div>
     </div>
         </body>
         </html>
     """)
 
-    return result
-
 
 if __name__ == "__main__":
     if len(sys.argv) != 2 + 1:
         print("Please enter a post ID and display format as argument")
     else:
-        print(show_post_and_comment_thread(postid=sys.argv[1], display_format=sys.argv[2]))
+        util.print_chunks(cache.page("posts", (sys.argv[1], sys.argv[2]),
+                                     lambda: show_post_and_comment_thread(postid=sys.argv[1], display_format=sys.argv[2])))
 
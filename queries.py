@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""Registry of the GraphQL documents sent to the API endpoint.
+
+Each operation is a static document, declared once at import time, that takes
+everything that changes from one request to the next (IDs, slugs, views,
+offsets) as GraphQL variables instead of having it interpolated into the query
+text. Since the text of an operation never changes:
+
+- it is minified and hashed once, and with GRAPHQL_PERSISTED_QUERIES in
+  config.py only the SHA-256 hash is sent (automatic persisted queries), with
+  the full text sent just once to register it if the API endpoint hasn't seen
+  it yet;
+- the response cache key is derived from the operation and its variables (see
+  cache.response_key).
+
+Fields that only some pages use are marked with @include(if: $with...), so
+that each page asks for just what it shows without needing a document of its
+own (e.g. users.get_posts_for_user only fetches post bodies for the feed).
+
+The "queries" display format still shows the full text, along with the
+variables (see Query.show)."""
+
+import hashlib
+import html
+import json
+import re
+from urllib.parse import quote
+
+import config
+
+PERSISTED_QUERIES = getattr(config, "GRAPHQL_PERSISTED_QUERIES", False)
+
+# Maps the SHA-256 hash of each document to its Query
+REGISTRY = {}
+
+COMMENT_RE = re.compile(r'#[^\n]*')
+# Whitespace that can be dropped: any run of it next to punctuation
+PUNCTUATOR_SPACE_RE = re.compile(r'\s*([{}():,!$=\[\]])\s*')
+
+
+def minify(document):
+    """Strip the comments and unneeded whitespace from a GraphQL document (which
+    is assumed not to contain string literals)."""
+    document = COMMENT_RE.sub("", document)
+    document = " ".join(document.split())
+    return PUNCTUATOR_SPACE_RE.sub(r'\1', document)
+
+
+def canonical_json(variables):
+    """Serialize variables the same way every time, for use in cache keys and
+    URLs."""
+    return json.dumps(variables, sort_keys=True, separators=(",", ":"))
+
+
+class Query(object):
+    """A GraphQL operation. The document should be a named query whose name is
+    the same as name, which is also used as the operation name for the
+    X-Apollo-Operation-Name header and for looking up the cache TTL (see
+    cache.TTLS)."""
+
+    def __init__(self, name, document):
+        self.name = name
+        self.document = document
+        self.text = minify(document)
+        self.sha256 = hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+        REGISTRY[self.sha256] = self
+
+    def __repr__(self):
+        return "Query(%r, %s)" % (self.name, self.sha256[:12])
+
+    def show(self, variables):
+        """The document and its variables, with a link that runs them, for the
+        "queries" display format."""
+        query_url = (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(self.document)
+                     + "&variables=" + quote(json.dumps(variables)))
+        return (self.document + "\nvariables: " + html.escape(json.dumps(variables, indent=2)) +
+                ('''\n<a href="%s">Run this query</a>\n\n''' % html.escape(query_url)))
@@ -2,20 +2,23 @@
 import pdb
 
 import sys
-from urllib.parse import quote
+import json
 import datetime
+import functools
 
 import config
+import cache
 import util
 import linkpath
+import queries
 
-def get_sequence(sequenceid, run_query=True):
-    query = ("""
-    {
+
+GET_SEQUENCE = queries.Query("get_sequence", """
+    query get_sequence($sequenceId: String) {
       sequence(
         input: {
           selector: {
-            _id: "%s"
+            _id: $sequenceId
           }
         }
       ) {
@@ -53,22 +56,24 @@ def get_sequence(sequenceid, run_query=True):
         }
       }
     }
-    """ % sequenceid)
+    """)
 
+
+def get_sequence(sequenceid, run_query=True):
+    variables = {"sequenceId": sequenceid}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return GET_SEQUENCE.show(variables)
 
-    request = util.send_query(query, operation_name="get_sequence")
+    request = util.send_query(GET_SEQUENCE, variables)
     return util.get_from_request(request, ['data', 'sequence', 'result'])
 
 
-def get_chapter(chapterid, run_query=True):
-    query = ("""
-    {
+GET_CHAPTER = queries.Query("get_chapter", """
+    query get_chapter($chapterId: String) {
       chapter(
         input: {
           selector: {
-            _id: "%s"
+            _id: $chapterId
           }
         }
       ) {
@@ -80,24 +85,121 @@ def get_chapter(chapterid, run_query=True):
         }
       }
     }
-    """ % chapterid)
+    """)
+
 
+def get_chapter(chapterid, run_query=True):
+    variables = {"chapterId": chapterid}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return GET_CHAPTER.show(variables)
 
-    request = util.send_query(query, operation_name="get_chapter")
+    request = util.send_query(GET_CHAPTER, variables)
     return util.get_from_request(request, ['data', 'chapter', 'result'])
 
 
+@functools.lru_cache(maxsize=None)
+def chapters_query(count):
+    """The query for the posts of count chapters, with the i-th chapter
+    (variable $chapter<i>) under the alias chapter<i>."""
+    document = "\n    query get_chapters"
+    if count:
+        document += "(%s)" % ", ".join("$chapter%s: String" % i for i in range(count))
+    document += " {"
+    for i in range(count):
+        document += ("""
+      chapter%s: chapter(
+        input: {
+          selector: {
+            _id: $chapter%s
+          }
+        }
+      ) {
+        result {
+          posts {
+            title
+            pageUrl
+          }
+        }
+      }""" % (i, i))
+    document += "\n    }\n    "
+    return queries.Query("get_chapters", document)
+
+
+def get_chapters(chapterids, run_query=True):
+    """Fetch the posts of every chapter in chapterids with a single aliased
+    query, rather than one get_chapter query per chapter. Returns a tuple (list
+    of chapters in the same order as chapterids, status code)."""
+    if not chapterids:
+        # A query with no fields isn't valid GraphQL, and there is nothing to
+        # ask for anyway
+        return "" if not run_query else ([], 200)
+    query = chapters_query(len(chapterids))
+    variables = {"chapter%s" % i: chapterid for i, chapterid in enumerate(chapterids)}
+
+    if not run_query:
+        return query.show(variables)
+
+    request = util.send_query(query, variables)
+    data, status_code = util.get_from_request(request, ['data'])
+    chapters = [util.safe_get(data, ["chapter%s" % i, "result"]) for i in range(len(chapterids))]
+    return (chapters, status_code)
+
+
+def get_sequence_with_chapters(sequenceid):
+    """Return a tuple ((sequence, chapters), status code), where chapters is the
+    list of chapter results in the same order as sequence["chapters"]. The
+    assembled sequence is cached as a unit, so a cached sequence page needs no
+    queries at all."""
+    key = cache.response_key(config.GRAPHQL_URL, "get_sequence_with_chapters", {"sequenceId": sequenceid})
+    cached = cache.get(key)
+    if cached is not None:
+        assembled = json.loads(cached)
+        return ((assembled["sequence"], assembled["chapters"]), 200)
+
+    sequence, status_code = get_sequence(sequenceid)
+    if status_code != 200:
+        return (None, status_code)
+    if sequence is None:
+        # No such sequence; the response saying so is already cached (for
+        # cache.NEGATIVE_TTL seconds), so there is nothing to assemble
+        return ((None, []), 200)
+    chapterids = [chapterdict["_id"] for chapterdict in util.safe_get(sequence, "chapters", [])]
+    chapters, status_code = get_chapters(chapterids)
+    if status_code != 200:
+        return (None, status_code)
+
+    cache.put(key, "get_sequence_with_chapters",
+              json.dumps({"sequence": sequence, "chapters": chapters}).encode("utf-8"),
+              cache.ttl_for("get_sequence_with_chapters"))
+    return ((sequence, chapters), 200)
+
+
 def show_sequence(sequenceid, display_format):
+    if display_format == "queries":
+        # The chapter query needs the chapter IDs, so we have to actually run
+        # the sequence query to be able to show it
+        sequence, status_code = get_sequence(sequenceid)
+        if status_code != 200:
+            return util.error_page("sequence", sequenceid, status_code)
+        if sequence is None:
+            return util.error_page("sequence", sequenceid, 404)
+        chapterids = [chapterdict["_id"] for chapterdict in util.safe_get(sequence, "chapters", [])]
+        result = "<pre>"
+        result += get_sequence(sequenceid, run_query=False) + "\n"
+        result += get_chapters(chapterids, run_query=False) + "\n"
+        result += "</pre>\n"
+        return result
+
+    sequence_and_chapters, status_code = get_sequence_with_chapters(sequenceid)
+    if status_code != 200:
+        return util.error_page("sequence", sequenceid, status_code)
+    sequence, chapters = sequence_and_chapters
+    if sequence is None:
+        return util.error_page("sequence", sequenceid, 404)
     result = ("""<!DOCTYPE html>
     <html>
     """)
-    run_query = False if display_format == "queries" else True
-    sequence_and_status_code = get_sequence(sequenceid)
-    if status_code != 200:
-        return util.error_message_string("sequence", sequenceid, status_code)
-    result = util.show_head(title=util.safe_get(sequence, "title"),
+    result += util.show_head(title=util.safe_get(sequence, "title", default=""),
                              author=util.safe_get(sequence, ["user", "username"]),
                              date=util.safe_get(sequence, "createdAt"),
                              publisher="LessWrong 2.0" if "lesswrong" in config.GRAPHQL_URL
@@ -108,21 +210,18 @@ def show_sequence(sequenceid, display_format):
     #     ])
     result += '''<div id="wrapper">'''
     result += '''<div id="content">'''
-    result += "<h1>" + util.safe_get(sequence, "title") + "</h1>\n"
-    for chapterdict in util.safe_get(sequence, "chapters"):
-        chapterid = chapterdict["_id"]
-        chapter, status_code = get_chapter(chapterid)
-        if status_code != 200:
-            return util.error_message_string("chapter", chapterid, status_code)
+    result += "<h1>" + util.htmlescape(util.safe_get(sequence, "title", default="")) + "</h1>\n"
+    for chapterdict, chapter in zip(util.safe_get(sequence, "chapters", []), chapters):
         result += "<h2>" + util.safe_get(chapterdict, "title", default="") + "</h2>"
         result += "<ul>\n"
-        for postdict in util.safe_get(chapter, "posts"):
+        for postdict in util.safe_get(chapter, "posts", []):
             alt_urls = util.alt_urls(util.safe_get(postdict, "pageUrl"))
             result += '''  <li><a href="%s">%s</a></li>\n''' % (
                     alt_urls['reader'],
                     util.safe_get(postdict, "title")
                     )
         result += "</ul>\n"
+    result += util.stale_notice()
     result += ("""
     </div>
     </div>
@@ -1,48 +1,172 @@
 #!/usr/bin/env python3
 
 import sys
+import bisect
+import functools
 import json
 import re
-import requests
 from urllib.parse import quote
 
 import util
 import linkpath
 import config
+import mirror
+import cache
 
 ALGOLIA_URL = ""
+# Search the full-text index in the local mirror (see mirror.py) instead of
+# sending the search to Algolia
+LOCAL_SEARCH = getattr(config, "LOCAL_SEARCH", False)
+HITS_PER_PAGE = 30
+# Result bodies are cut down to at most SNIPPET_COUNT windows of text around
+# the matches, each reaching SNIPPET_CONTEXT characters to either side
+SNIPPET_CONTEXT = 150
+SNIPPET_COUNT = 3
 
+HIGHLIGHT = '<span style="background-color: #ffff00;">%s</span>'
 
-def highlighted_search_string(body, string):
-    # Body is already html escaped, so we need string to be on the same level.
-    # Also, we need to escape and then highlight, because if we highlight and
-    # then escape, the highlighting tag will also be escaped.
-    search_terms = set(map(util.htmlescape, string.lower().split()))
 
-    result = ""
-    pat = re.compile(r'\w+|\W')
+@functools.lru_cache(maxsize=128)
+def search_terms_regex(string):
+    """One regex matching any of the search terms in string, or None if there
+    are none. As before, a term matches a whole word (or a single punctuation
+    character), ignoring case. Quote marks only group the words of a phrase
+    (see mirror._fts_query), so each word of a "quoted phrase" is highlighted
+    on its own and the quote marks themselves aren't."""
+    terms = set(string.replace('"', ' ').lower().split())
+    words = sorted((term for term in terms if re.fullmatch(r'\w+', term)), key=len, reverse=True)
+    characters = [term for term in terms if re.fullmatch(r'\W', term)]
+    alternatives = []
+    if words:
+        alternatives.append(r'(?<!\w)(?:%s)(?!\w)' % "|".join(map(re.escape, words)))
+    alternatives.extend(map(re.escape, characters))
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives), re.IGNORECASE)
+
+
+def match_offsets(text, string):
+    """The (start, end) offsets of the search terms in text, in order."""
+    regex = search_terms_regex(string)
+    if regex is None:
+        return []
+    return [match.span() for match in regex.finditer(text)]
+
 
-    for word in pat.findall(body):
-        if word.lower() in search_terms:
-            result += '<span style="background-color: #ffff00;">' + word + '</span>'
-        else:
-            result += word
+def highlighted(text, offsets, start=0, end=None):
+    """Escape text[start:end] and highlight the matches at offsets in it."""
+    end = len(text) if end is None else end
+    parts = []
+    position = start
+    for match_start, match_end in offsets[bisect.bisect_left(offsets, (start,)):]:
+        if match_end > end:
+            break
+        parts.append(util.htmlescape(text[position:match_start]))
+        parts.append(HIGHLIGHT % util.htmlescape(text[match_start:match_end]))
+        position = match_end
+    parts.append(util.htmlescape(text[position:end]))
+    return "".join(parts)
 
+
+def snippet_windows(text, offsets, context=SNIPPET_CONTEXT, count=SNIPPET_COUNT):
+    """Up to count (start, end) windows of text around the matches at offsets,
+    widened to whole words. Overlapping windows are merged, up to a length of
+    four times context."""
+    windows = []
+    for match_start, match_end in offsets:
+        start = max(match_start - context, 0)
+        end = min(match_end + context, len(text))
+        if windows and start <= windows[-1][1]:
+            if end - windows[-1][0] <= 4 * context:
+                windows[-1] = (windows[-1][0], end)
+                continue
+            start = windows[-1][1]
+        if len(windows) == count:
+            break
+        windows.append((start, end))
+    result = []
+    for start, end in windows:
+        if start > 0:
+            space = text.rfind(" ", 0, start)
+            start = space + 1 if space >= 0 and start - space < 20 else start
+        if end < len(text):
+            space = text.find(" ", end)
+            end = space if 0 <= space and space - end < 20 else end
+        result.append((start, end))
     return result
 
 
-def search_posts(string):
-    data = '''{"requests":[{"indexName":"test_posts","params":"query=%s&hitsPerPage=30&page=0"}]}''' % quote(string)
-    r = requests.post(ALGOLIA_URL, data=data)
+def highlighted_search_string(body, string):
+    """The parts of body (plain text) around the search terms, escaped, with
+    the terms highlighted, or None if none of the terms are in body. Finding
+    the terms takes a single pass over body, whatever its length."""
+    offsets = match_offsets(body, string)
+    if not offsets:
+        return None
+    result = ""
+    windows = snippet_windows(body, offsets)
+    for i, (start, end) in enumerate(windows):
+        if start > 0 or i > 0:
+            result += "… "
+        result += highlighted(body, offsets, start, end)
+    if windows[-1][1] < len(body):
+        result += " …"
+    return result
+
 
-    return util.get_from_request(r, ['results', 0, 'hits'])
+def highlighted_snippet(snippet):
+    """Escape a snippet from mirror.search and highlight the matches in it."""
+    return (util.htmlescape(snippet)
+            .replace(mirror.HIGHLIGHT_START, '<span style="background-color: #ffff00;">')
+            .replace(mirror.HIGHLIGHT_END, '</span>'))
 
 
-def search_comments(string):
-    data = '''{"requests":[{"indexName":"test_comments","params":"query=%s&hitsPerPage=30&page=0"}]}''' % quote(string)
-    r = requests.post(ALGOLIA_URL, data=data)
+def local_search(kind, string, page):
+    hits = mirror.search(kind, string, page, HITS_PER_PAGE)
+    if hits is None:
+        return ([], 503)
+    return (hits, 200)
 
-    return util.get_from_request(r, ['results', 0, 'hits'])
+
+def normalized_query(string):
+    """Case-fold the search string and collapse its whitespace, for the cache
+    key: Algolia ignores both, so searches that only differ in these ways
+    share a cache entry. Anything more (such as sorting the terms) could
+    change the ranking of the hits."""
+    return " ".join(string.casefold().split())
+
+
+def algolia_search(index_name, string, page):
+    """The hits for string in the Algolia index, cached for the TTL of the
+    operation "search_" + index_name (see cache.TTLS)."""
+    operation_name = "search_" + index_name
+    key = cache.response_key(ALGOLIA_URL, operation_name,
+                             {"query": normalized_query(string), "hitsPerPage": HITS_PER_PAGE, "page": page})
+    body = cache.get(key)
+    if body is not None:
+        return util.get_from_request(cache.CachedResponse(body), ['results', 0, 'hits'])
+    data = '''{"requests":[{"indexName":"test_%s","params":"query=%s&hitsPerPage=%s&page=%s"}]}''' % (index_name, quote(string), HITS_PER_PAGE, page)
+    r = util.get_session().post(ALGOLIA_URL, data=data, timeout=util.HTTP_TIMEOUT)
+    hits, status_code = util.get_from_request(r, ['results', 0, 'hits'])
+    if status_code != 200:
+        return ([], status_code)
+    if hits is None:
+        # A 200 that isn't a list of hits (e.g. an error from Algolia)
+        return ([], 502)
+    cache.put(key, operation_name, r.content, cache.ttl_for(operation_name))
+    return (hits, status_code)
+
+
+def search_posts(string, page=0):
+    if LOCAL_SEARCH:
+        return local_search("post", string, page)
+    return algolia_search("posts", string, page)
+
+
+def search_comments(string, page=0):
+    if LOCAL_SEARCH:
+        return local_search("comment", string, page)
+    return algolia_search("comments", string, page)
 
 
 def show_comment(comment, string):
@@ -64,7 +188,17 @@ def show_comment(comment, string):
                comment['_id'],
                comment['postedAt']))
 
-    result += '''<pre style="font-family: Lato, Helvetica, sans-serif; word-wrap: break-word; white-space: pre-wrap; white-space: -moz-pre-wrap;">%s</pre>\n''' % highlighted_search_string(util.htmlescape(comment['body']), string)
+    if '_snippet' in comment:
+        body = highlighted_snippet(comment['_snippet'] or "")
+    else:
+        # Algolia may have matched something other than the body (e.g. the
+        # author), in which case the start of the body is shown
+        text = comment.get('body') or ""
+        body = highlighted_search_string(text, string)
+        if body is None:
+            end = snippet_windows(text, [(0, 0)], count=1)[0][1]
+            body = util.htmlescape(text[:end]) + (" …" if end < len(text) else "")
+    result += '''<pre style="font-family: Lato, Helvetica, sans-serif; word-wrap: break-word; white-space: pre-wrap; white-space: -moz-pre-wrap;">%s</pre>\n''' % body
     result += "</div>"
 
     return result
@@ -88,14 +222,14 @@ def show_post(post, string, seen):
                display_name=util.safe_get(post, ['authorDisplayName'])
            ),
            post['postedAt']))
-    matched_in_body = False
-    if 'body' in post:
-        for term in string.split():
-            # Check if any of the search terms is in the body
-            if term.lower() in util.safe_get(post, 'body', default="").lower():
-                matched_in_body = True
-    if matched_in_body:
-        result += '''<pre style="font-family: Lato, Helvetica, sans-serif; word-wrap: break-word; white-space: pre-wrap; white-space: -moz-pre-wrap;">%s</pre>\n''' % highlighted_search_string(util.htmlescape(post['body']), string)
+    body = None
+    if post.get('_snippet'):
+        # From the local index, which has already found the matches
+        body = highlighted_snippet(post['_snippet'])
+    elif 'body' in post:
+        body = highlighted_search_string(util.safe_get(post, 'body', default=""), string)
+    if body is not None:
+        result += '''<pre style="font-family: Lato, Helvetica, sans-serif; word-wrap: break-word; white-space: pre-wrap; white-space: -moz-pre-wrap;">%s</pre>\n''' % body
     else:
         if post['_id'] in seen:
             # If we didn't even match inside the body and we've seen this post
@@ -107,43 +241,80 @@ def show_post(post, string, seen):
     result += "</div>\n"
     return result
 
-def print_comments(string):
-    for comment in search_comments(string):
-        print(show_comment(comment, string))
 
-def print_posts(string):
-    seen = set()
-    for post in search_posts(string):
-        print(show_post(post, string, seen))
+def show_comments(string, page=0):
+    """The HTML for a page of comment results, and whether it was a full page
+    (so that there may be more)."""
+    result = ""
+    comments, status_code = search_comments(string, page)
+    if status_code != 200:
+        return (util.error_message_string("search", "", status_code), False)
+    for comment in comments:
+        result += show_comment(comment, string) + "\n"
+    return (result, len(comments) >= HITS_PER_PAGE)
 
 
-if __name__ == "__main__":
-    arg_count = 2
+def show_posts(string, page=0):
+    """The HTML for a page of post results, and whether it was a full page."""
+    result = ""
+    seen = set()
+    posts, status_code = search_posts(string, page)
+    if status_code != 200:
+        return (util.error_message_string("search", "", status_code), False)
+    for post in posts:
+        result += show_post(post, string, seen) + "\n"
+    return (result, len(posts) >= HITS_PER_PAGE)
 
-    if len(sys.argv) != arg_count + 1:
-        print("Unexpected number of args")
-        sys.exit()
 
-    with open(sys.argv[1], "r") as f:
+def load_algolia_url(path):
+    global ALGOLIA_URL
+    with open(path, "r") as f:
         ALGOLIA_URL = next(f).strip()
 
-    search_string = sys.argv[2]
-    print(''' <!DOCTYPE html>
-        <html>''')
-    print(util.show_head(search_string))
-    print("<body>")
-    print(util.show_navbar(search_value=search_string))
-    print('''<div id="wrapper">''')
-    print('''<div id="content">''')
-    print('''<ul>
+
+def page_link(search_string, page):
+    return "%s?q=%s&amp;page=%s" % (linkpath.search(), quote(search_string), page)
+
+
+def show_search_results(search_string, page=0):
+    result = ''' <!DOCTYPE html>
+        <html>\n'''
+    result += util.show_head(search_string) + "\n"
+    result += "<body>\n"
+    result += util.show_navbar(search_value=search_string) + "\n"
+    result += '''<div id="wrapper">\n'''
+    result += '''<div id="content">\n'''
+    result += '''<ul>
                 <li><a href="#posts">Jump to post results</a></li>
                 <li><a href="#comments">Jump to comment results</a></li>
-            </ul>''')
-    print('''<h2 id="posts">Post results</h2>''')
-    print_posts(search_string)
-    print('''<h2 id="comments">Comment results</h2>''')
-    print_comments(search_string)
-    print("</div>")
-    print("</div>")
-    print('''</body>
-        </html>''')
+            </ul>\n'''
+    # The two searches don't depend on each other
+    (posts_html, more_posts), (comments_html, more_comments) = util.run_concurrently(
+        lambda: show_posts(search_string, page),
+        lambda: show_comments(search_string, page))
+    result += '''<h2 id="posts">Post results</h2>\n'''
+    result += posts_html
+    result += '''<h2 id="comments">Comment results</h2>\n'''
+    result += comments_html
+    if page > 0:
+        result += '''<a href="%s">← previous page</a>''' % page_link(search_string, page - 1)
+        if more_posts or more_comments:
+            result += " · "
+    if more_posts or more_comments:
+        result += '''<a href="%s">next page →</a>''' % page_link(search_string, page + 1)
+    result += "</div>\n"
+    result += "</div>\n"
+    result += '''</body>
+        </html>'''
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2 + 1, 3 + 1):
+        print("Unexpected number of args")
+        sys.exit()
+
+    if not LOCAL_SEARCH:
+        load_algolia_url(sys.argv[1])
+    page = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3].isdigit() else 0
+    print(show_search_results(sys.argv[2], page))
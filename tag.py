@@ -1,22 +1,22 @@
 #!/usr/bin/env python3
 
 import sys
-from urllib.parse import quote
 import datetime
 from typing import Any
 
 import config
 import util
 import linkpath
+import mirror
+import queries
 
 
-def get_content_for_tag(tagslug, run_query=True) -> tuple[Any, int] | str:
-    query = ("""
-    {
+GET_CONTENT_FOR_TAG = queries.Query("get_content_for_tag", """
+    query get_content_for_tag($slug: String) {
       tag(
         input: {
           selector: {
-            slug: "%s"
+            slug: $slug
           }
         }
       ) {
@@ -27,27 +27,36 @@ def get_content_for_tag(tagslug, run_query=True) -> tuple[Any, int] | str:
         }
       }
     }
-    """ % tagslug)
+    """)
+
 
+def get_content_for_tag(tagslug, run_query=True) -> tuple[Any, int] | str:
+    variables = {"slug": tagslug}
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return GET_CONTENT_FOR_TAG.show(variables)
 
-    request = util.send_query(query, operation_name="get_content_for_tag")
+    tag = mirror.tag(tagslug)
+    if tag is not None:
+        return (tag, 200)
+    request = util.send_query(GET_CONTENT_FOR_TAG, variables)
     return util.get_from_request(request, ['data', 'tag', 'result'])
 
 def show_tag(tagslug, display_format):
-    print("""<!DOCTYPE html>
+    result = """<!DOCTYPE html>
     <html>
-    """)
+    """
     run_query = False if display_format == "queries" else True
-    tag_content = get_content_for_tag(tagslug, run_query=run_query)
-    if display_format == "queries":
-        result = "<pre>"
-        result += tag_content + "\n"
+    tag_content_and_status_code = get_content_for_tag(tagslug, run_query=run_query)
+    if isinstance(tag_content_and_status_code, str):
+        result += "<pre>"
+        result += tag_content_and_status_code + "\n"
         result += "</pre>\n"
         return result
+    tag_content, status_code = tag_content_and_status_code
+    if status_code != 200:
+        return result + util.error_message_string("tag", tagslug, status_code)
 
-    result = util.show_head(title=tagslug,
+    result += util.show_head(title=tagslug,
                              author="",
                              date="",
                              publisher="LessWrong 2.0" if "lesswrong" in config.GRAPHQL_URL
@@ -61,7 +70,8 @@ def show_tag(tagslug, display_format):
     result += '''<div id="content">'''
     result += "<h1>" + util.htmlescape(tagslug) + "</h1>\n"
     result += " ·\n"
-    result += util.cleanHtmlBody(util.substitute_alt_links(util.safe_get(tag_content, ['description', 'html'])))
+    result += util.clean_html_body(util.safe_get(tag_content, ['description', 'html']))
+    result += util.stale_notice()
     result += ("""
     </div>
     </div>
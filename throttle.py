@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Circuit breaker and rate limiter for queries to the API endpoint.
+
+When the API endpoint starts failing or blocking us (403, 429, 5xx), there is
+no point in every page view waiting on a round trip to find that out, and
+hammering it only makes a block last longer. So util.send_query asks allow
+before each request and reports the outcome to record afterwards:
+
+- Each operation has a circuit breaker. After BREAKER_THRESHOLD failures in a
+  row it opens, and requests for that operation are turned away without being
+  sent (util.send_query then falls back to a stale copy from the cache, or to
+  the error message with a link to the official site). Once the cooldown has
+  passed, a single probe request is let through; if it succeeds the breaker
+  closes again, otherwise it stays open for twice as long as before.
+
+- All requests share a token bucket, refilled at the current rate. The rate
+  is halved whenever we are told to slow down (429) and creeps back up to
+  RATE_LIMIT as requests succeed. A Retry-After header stops all requests
+  until the time it gives.
+
+The state lives in the cache database (see cache.py), so it is shared by all
+processes. If the database can't be used, requests are always allowed."""
+
+import email.utils
+import time
+
+import config
+import cache
+
+BREAKER_THRESHOLD = getattr(config, "BREAKER_THRESHOLD", 5)
+BREAKER_COOLDOWN = getattr(config, "BREAKER_COOLDOWN", 30)
+BREAKER_MAX_COOLDOWN = getattr(config, "BREAKER_MAX_COOLDOWN", 10 * 60)
+# How long a probe has to report back before another one is let through
+PROBE_TIMEOUT = 60
+
+RATE_LIMIT = getattr(config, "RATE_LIMIT", 10)  # requests per second
+RATE_BURST = getattr(config, "RATE_BURST", 20)
+RATE_MIN = 0.5
+# Rather than wait longer than this for a token, turn the request away
+RATE_MAX_WAIT = getattr(config, "RATE_MAX_WAIT", 2)
+
+FAILURE_STATUS_CODES = {403, 429, 500, 502, 503, 504}
+
+
+class RejectedResponse(object):
+    """Stands in for a requests.Response when a request is turned away without
+    being sent. It looks like a 503 from the API endpoint."""
+
+    status_code = 503
+    content = b""
+    text = ""
+    headers = {}
+
+    def json(self):
+        raise ValueError("request was not sent")
+
+
+def _allow(conn, operation, now):
+    breaker = conn.execute("SELECT state, until FROM breakers WHERE operation = ?",
+                           (operation,)).fetchone()
+    if breaker is not None and breaker[0] != "closed" and now < breaker[1]:
+        # Either still cooling down, or a probe is already out
+        return (False, 0)
+    bucket = conn.execute("SELECT tokens, updated, rate, blocked_until FROM buckets WHERE name = 'upstream'").fetchone()
+    tokens, updated, rate, blocked_until = bucket or (RATE_BURST, now, RATE_LIMIT, 0)
+    if now < blocked_until:
+        return (False, 0)
+    tokens = min(RATE_BURST, tokens + (now - updated) * rate) - 1
+    wait = -tokens / rate if tokens < 0 else 0
+    if wait > RATE_MAX_WAIT:
+        return (False, 0)
+    conn.execute("INSERT OR REPLACE INTO buckets VALUES ('upstream', ?, ?, ?, ?)",
+                 (tokens, now, rate, blocked_until))
+    if breaker is not None and breaker[0] != "closed":
+        # This request is the probe
+        conn.execute("UPDATE breakers SET state = 'half-open', until = ? WHERE operation = ?",
+                     (now + PROBE_TIMEOUT, operation))
+    return (True, wait)
+
+
+def allow(operation):
+    """Return True if a request for operation may be sent (after waiting for
+    the rate limiter, if need be), or False if it should be turned away."""
+    result = cache.transaction(_allow, operation or "", time.time())
+    if result is None:
+        # The database can't be used
+        return True
+    allowed, wait = result
+    if allowed and wait > 0:
+        time.sleep(wait)
+    return allowed
+
+
+def retry_after(response):
+    """The number of seconds the Retry-After header of response asks us to
+    wait, or 0 if there is none."""
+    value = getattr(response, "headers", {}).get("Retry-After")
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _record(conn, operation, status_code, wait, now):
+    failed = status_code is None or status_code in FAILURE_STATUS_CODES
+    breaker = conn.execute("SELECT state, failures, trips FROM breakers WHERE operation = ?",
+                           (operation,)).fetchone()
+    state, failures, trips = breaker or ("closed", 0, 0)
+    if not failed:
+        if state != "closed" or failures:
+            conn.execute("INSERT OR REPLACE INTO breakers VALUES (?, 'closed', 0, 0, 0)", (operation,))
+    else:
+        failures += 1
+        if state == "half-open" or failures >= BREAKER_THRESHOLD:
+            trips += 1
+            cooldown = min(BREAKER_COOLDOWN * 2 ** (trips - 1), BREAKER_MAX_COOLDOWN)
+            conn.execute("INSERT OR REPLACE INTO breakers VALUES (?, 'open', ?, ?, ?)",
+                         (operation, failures, trips, now + cooldown))
+        else:
+            conn.execute("INSERT OR REPLACE INTO breakers VALUES (?, ?, ?, ?, 0)",
+                         (operation, state, failures, trips))
+
+    bucket = conn.execute("SELECT tokens, updated, rate, blocked_until FROM buckets WHERE name = 'upstream'").fetchone()
+    if bucket is None:
+        return
+    tokens, updated, rate, blocked_until = bucket
+    if status_code == 429 or wait:
+        rate = max(rate / 2, RATE_MIN)
+        blocked_until = max(blocked_until, now + wait)
+    elif not failed and rate < RATE_LIMIT:
+        rate = min(rate + RATE_LIMIT / 20, RATE_LIMIT)
+    else:
+        return
+    conn.execute("UPDATE buckets SET rate = ?, blocked_until = ? WHERE name = 'upstream'",
+                 (rate, blocked_until))
+
+
+def record(operation, response):
+    """Report the outcome of a request for operation: the response, or None if
+    the request failed without one (e.g. a timeout)."""
+    status_code = response.status_code if response is not None else None
+    wait = retry_after(response) if response is not None else 0
+    cache.transaction(_record, operation or "", status_code, wait, time.time())
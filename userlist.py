@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
-from urllib.parse import quote
 from typing import Any
 
 import config
 import util
 import linkpath
+import cache
+import queries
 
 
 def comments_to_posts_ratio(comment_count, post_count):
@@ -72,27 +73,13 @@ def big_vote_power(karma):
         return 2
     return 1
 
-def users_list_query(sort_by: str = "karma", run_query : bool = True) -> tuple[Any, int] | str:
-    sort_line = ""
-    if sort_by == "postCount":
-        sort_line = 'sort: {postCount: -1}'
-    elif sort_by == "commentCount":
-        sort_line = 'sort: {commentCount: -1}'
-    elif sort_by == "afKarma":
-        sort_line = 'sort: {afKarma: -1}'
-    elif sort_by == "afPostCount":
-        sort_line = 'sort: {afPostCount: -1}'
-    elif sort_by == "afCommentCount":
-        sort_line = 'sort: {afCommentCount: -1}'
-    else:
-        sort_line = 'sort: {karma: -1}'
-    query = ("""
-        {
+USERS_LIST_QUERY = queries.Query("users_list_query", """
+        query users_list_query($sort: JSON) {
           users(input: {
             terms: {
               view: "LWUsersAdmin"
               limit: 500
-              %s
+              sort: $sort
             }
           }) {
             results {
@@ -107,11 +94,17 @@ def users_list_query(sort_by: str = "karma", run_query : bool = True) -> tuple[A
             }
           }
         }
-    """ % sort_line)
+    """)
+
+
+def users_list_query(sort_by: str = "karma", run_query : bool = True) -> tuple[Any, int] | str:
+    if sort_by not in ("postCount", "commentCount", "afKarma", "afPostCount", "afCommentCount"):
+        sort_by = "karma"
+    variables = {"sort": {sort_by: -1}}
 
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
-    request = util.send_query(query, operation_name="users_list_query")
+        return USERS_LIST_QUERY.show(variables)
+    request = util.send_query(USERS_LIST_QUERY, variables)
     return util.get_from_request(request, ['data', 'users', 'results'])
 
 
@@ -122,7 +115,9 @@ def show_users_list(sort_by, display_format):
     else:
         users, status_code = users_and_status_code
         if status_code != 200:
+            cache.uncacheable_page()
             return util.error_message_string("userlist", "", status_code)
+        cache.tag_page(*["user:" + user['slug'] for user in users if user['slug']])
 
     if display_format == "queries":
         result = "<pre>"
@@ -202,6 +197,7 @@ def show_users_list(sort_by, display_format):
 
     result += "</div>"  # content
     result += "</div>"  # wrapper
+    result += util.stale_notice()
     result += "</body>"
     result += "</html>"
 
@@ -213,4 +209,5 @@ if __name__ == "__main__":
     if len(sys.argv) != arg_count + 1:
         print("Unexpected number of arguments")
     else:
-        print(show_users_list(sort_by=sys.argv[1], display_format=sys.argv[2]))
+        util.print_chunks(cache.page("userlist", (sys.argv[1], sys.argv[2]),
+                                     lambda: show_users_list(sort_by=sys.argv[1], display_format=sys.argv[2])))
@@ -1,32 +1,35 @@
 #!/usr/bin/env python3
 
 import sys
-from urllib.parse import quote
 
 import util
 import config
 import linkpath
+import cache
+import knownids
+import queries
 
 
 def html_page_for_user(username, display_format):
     run_query = False if display_format == "queries" else True
-    comments = get_comments_for_user(username, run_query=run_query)
-    posts = get_posts_for_user(username, run_query=run_query)
-    user_info_and_status_code = query_user_info(username, run_query=run_query)
-    if isinstance(user_info_and_status_code, str):
-        user_info = user_info_and_status_code
-    else:
-        user_info, status_code = user_info_and_status_code
-        if status_code != 200:
-            return util.error_message_string("users", username, status_code)
+    if run_query and not knownids.might_exist("user", username):
+        # Not cached, as the ID can become known at any time (see knownids)
+        cache.uncacheable_page()
+        yield util.error_page("users", username, 404)
+        return
+    comments_future, posts_future, user_info_future = util.start_concurrently(
+        lambda: get_comments_for_user(username, run_query=run_query),
+        lambda: get_posts_for_user(username, run_query=run_query),
+        lambda: query_user_info(username, run_query=run_query))
 
     if display_format == "queries":
         result = "<pre>"
-        result += comments + "\n"
-        result += posts + "\n"
-        result += user_info + "\n"
+        result += comments_future.result() + "\n"
+        result += posts_future.result() + "\n"
+        result += user_info_future.result() + "\n"
         result += "</pre>\n"
-        return result
+        yield result
+        return
 
     result = """<!DOCTYPE html>
     <html>
@@ -49,6 +52,17 @@ def html_page_for_user(username, display_format):
         result += ('<a title="Official EA Forum link" href="https://forum.effectivealtruism.org/users/' + username + '">EA</a> · ')
         result += ('<a title="GreaterWrong link" href="https://ea.greaterwrong.com/users/' + username + '">GW</a>')
     result += '</p>'
+    yield result
+    result = ""
+
+    user_info, status_code = user_info_future.result()
+    if status_code == 200 and user_info is None:
+        status_code = 404
+    if status_code != 200:
+        cache.uncacheable_page()
+        yield util.error_message_string("users", username, status_code)
+        yield "</div>\n</div>\n</body>\n</html>\n"
+        return
     result += '''<h2>User info</h2>'''
     result += '''  <dl>'''
     if "displayName" in user_info and user_info["displayName"]:
@@ -86,6 +100,9 @@ def html_page_for_user(username, display_format):
     '''
 
     result += '''<h2 id="posts">Posts</h2>'''
+    yield result
+    result = ""
+    posts = posts_future.result()
     for post in posts:
         result += '''<div style="border: 1px solid #B3B3B3; margin-bottom: 15px; padding: 10px; background-color: %s;">\n''' % config.COMMENT_COLOR
         result += '''    <a href="%s">%s</a>\n''' % (linkpath.posts(postid=util.safe_get(post, '_id'), postslug=util.safe_get(post, 'slug')), util.htmlescape(util.safe_get(post, 'title')))
@@ -93,46 +110,65 @@ def html_page_for_user(username, display_format):
         result += "</div>\n"
 
     result += '''<h2 id="comments">Comments</h2>'''
+    yield result
+    comments = comments_future.result()
     for comment in comments:
-        result += '''<div style="border: 1px solid #B3B3B3; margin-bottom: 15px; padding: 10px; background-color: %s;">\n''' % config.COMMENT_COLOR
-        if comment['post'] is None:
-            postslug = util.safe_get(comment, 'pageUrl', default="").split('/')[-1].split('#')[0]
-            result += '''    <a href="%s#%s">Comment</a> by <b>%s</b> on [deleted post]</b>\n''' % (linkpath.posts(postid=comment['postId'], postslug=postslug), util.safe_get(comment, '_id'), util.safe_get(comment, ['user', 'username']))
-            result += '''    %s\n''' % comment['postedAt']
+        yield cache.fragment("user-comment", comment,
+                             lambda: show_comment_card(comment, user_info),
+                             extra=(util.safe_get(user_info, 'slug'),
+                                    util.safe_get(user_info, 'username'),
+                                    util.safe_get(user_info, 'displayName'),
+                                    util.safe_get(comment, ['user', 'username']),
+                                    util.safe_get(comment, ['post', 'title']),
+                                    util.safe_get(comment, ['post', 'slug']),
+                                    comment['postId'], comment['pageUrl'], comment['postedAt']))
+
+    yield util.stale_notice()
+    yield '''
+        </div>
+        </div>
+        </body>
+        </html>
+    '''
+
+
+def show_comment_card(comment, user_info):
+    result = '''<div style="border: 1px solid #B3B3B3; margin-bottom: 15px; padding: 10px; background-color: %s;">\n''' % config.COMMENT_COLOR
+    if comment['post'] is None:
+        postslug = util.safe_get(comment, 'pageUrl', default="").split('/')[-1].split('#')[0]
+        result += '''    <a href="%s#%s">Comment</a> by <b>%s</b> on [deleted post]</b>\n''' % (linkpath.posts(postid=comment['postId'], postslug=postslug), util.safe_get(comment, '_id'), util.safe_get(comment, ['user', 'username']))
+        result += '''    %s\n''' % comment['postedAt']
+    else:
+        if "lesswrong" in config.GRAPHQL_URL:
+            official_link = '''<a href="%s" title="Official LessWrong 2.0 link">LW</a>''' % comment['pageUrl']
         else:
-            if "lesswrong" in config.GRAPHQL_URL:
-                official_link = '''<a href="%s" title="Official LessWrong 2.0 link">LW</a>''' % comment['pageUrl']
-            else:
-                official_link = '''<a href="%s" title="Official EA Forum link">EA</a>''' % comment['pageUrl']
-            result += ('''    Comment by
+            official_link = '''<a href="%s" title="Official EA Forum link">EA</a>''' % comment['pageUrl']
+        result += ('''    Comment by
                 <b>%s</b> on
                 <a href="%s">%s</a></b> ·
                 <a href="%s#%s">%s</a> ·
                 %s ·
                 <a href="%s" title="GreaterWrong link">GW</a>''' % (
-                    util.userlink(slug=util.safe_get(user_info, 'slug'),
-                                  username=util.safe_get(user_info, 'username'),
-                                  display_name=util.safe_get(user_info, 'displayName')),
-                    linkpath.posts(postid=comment['postId'], postslug=util.safe_get(comment, ['post', 'slug'])),
-                    util.htmlescape(comment['post']['title']),
-                    linkpath.posts(postid=comment['postId'], postslug=util.safe_get(comment, ['post', 'slug'])),
-                    comment['_id'],
-                    comment['postedAt'],
-                    official_link,
-                    util.official_url_to_gw(comment['pageUrl'])))
-        comment_body = util.cleanHtmlBody(comment['htmlBody'])
-        result += '''    %s\n''' % comment_body
-        result += "</div>\n"
-
-    result += '''
-        </div>
-        </div>
-        </body>
-        </html>
-    '''
+                util.userlink(slug=util.safe_get(user_info, 'slug'),
+                              username=util.safe_get(user_info, 'username'),
+                              display_name=util.safe_get(user_info, 'displayName')),
+                linkpath.posts(postid=comment['postId'], postslug=util.safe_get(comment, ['post', 'slug'])),
+                util.htmlescape(comment['post']['title']),
+                linkpath.posts(postid=comment['postId'], postslug=util.safe_get(comment, ['post', 'slug'])),
+                comment['_id'],
+                comment['postedAt'],
+                official_link,
+                util.official_url_to_gw(comment['pageUrl'])))
+    comment_body = util.cleanHtmlBody(comment['htmlBody'])
+    result += '''    %s\n''' % comment_body
+    result += "</div>\n"
     return result
 
 
+# The feed only has the most recent comments
+FEED_LIMIT = 50
+
+
 def feed_for_user(username):
     result = ('''<?xml version="1.0" encoding="UTF-8"?>
     <rss version="2.0">
@@ -140,9 +176,17 @@ def feed_for_user(username):
             <title>%s</title>
             <description>%s</description>
             <language>en-us</language>\n''' % (username + " feed - " + config.TITLE, username + "’s posts and comments on the Effective Altruism Forum"))
+    if not knownids.might_exist("user", username):
+        yield result + '''</channel>
+    </rss>'''
+        return
+    comments_future, posts_future = util.start_concurrently(
+        lambda: get_comments_for_user(username, limit=FEED_LIMIT),
+        lambda: get_posts_for_user(username, with_bodies=True))
+    yield result
 
-    comments = get_comments_for_user(username)
-    posts = get_posts_for_user(username)
+    comments = comments_future.result()
+    posts = posts_future.result()
 
     all_content = []
     all_content.extend(comments)
@@ -151,7 +195,7 @@ def feed_for_user(username):
 
     for content in all_content:
         content_type = "post" if "title" in content else "comment"
-        result += "<item>\n"
+        result = "<item>\n"
         if content_type == "post":
             result += "    <title>%s</title>\n" % content['title']
         else:
@@ -166,17 +210,15 @@ def feed_for_user(username):
         result += '''    <guid>%s</guid>\n''' % content['_id']
         result += '''    <pubDate>%s</pubDate>\n''' % content['postedAt']
         result += "</item>\n"
+        yield result
 
-    result += '''</channel>
+    yield '''</channel>
     </rss>'''
 
-    return result
-
 
-def query_user_info(userslug, run_query=True):
-    query = ("""
-    {
-      user(input: {selector: {slug: "%s"}}) {
+QUERY_USER_INFO = queries.Query("query_user_info", """
+    query query_user_info($slug: String) {
+      user(input: {selector: {slug: $slug}}) {
         result {
           _id
           slug
@@ -184,7 +226,6 @@ def query_user_info(userslug, run_query=True):
           htmlBio
           website
           location
-          profile
           displayName
           username
           postCount
@@ -192,31 +233,26 @@ def query_user_info(userslug, run_query=True):
         }
       }
     }
-    """ % userslug)
+    """)
+
 
+def query_user_info(userslug, run_query=True):
+    variables = {"slug": userslug}
     if not run_query:
-        query_url = config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % query_url)
+        return QUERY_USER_INFO.show(variables)
 
-    request = util.send_query(query, operation_name="query_user_info")
+    request = util.send_query(QUERY_USER_INFO, variables)
     return util.get_from_request(request, ['data', 'user', 'result'])
 
 
-def get_comments_for_user(username, run_query=True):
-    userid_and_status_code = util.userslug_to_userid(username, run_query=True)
-    if isinstance(userid_and_status_code, str):
-        userid = userid_and_status_code
-    else:
-        userid, status_code = userid_and_status_code
-        if status_code != 200:
-            return util.error_message_string("users", username, status_code)
-    query = ("""
-    {
+GET_COMMENTS_FOR_USER = queries.Query("get_comments_for_user", """
+    query get_comments_for_user($userId: String, $limit: Int, $offset: Int) {
       comments(input: {
         terms: {
           view: "userComments",
-          userId: "%s",
-          limit: 50,
+          userId: $userId,
+          limit: $limit,
+          offset: $offset,
         }
       }) {
         results {
@@ -227,30 +263,46 @@ def get_comments_for_user(username, run_query=True):
           }
           user {
             username
-            slug
-            displayName
           }
-          userId
           postId
           postedAt
           pageUrl
           htmlBody
-          baseScore
-          voteCount
         }
       }
     }
-    """ % userid)
+    """)
+
+
+# Number of comments fetched per request by get_comments_for_user
+COMMENTS_PAGE_SIZE = 500
+
+
+def get_comments_for_user(username, run_query=True, limit=None):
+    """The user's most recent limit comments, or their whole history (fetched
+    COMMENTS_PAGE_SIZE at a time by util.fetch_all_pages) if limit is None."""
+    userid_and_status_code = util.userslug_to_userid(username, run_query=True)
+    if isinstance(userid_and_status_code, str):
+        userid = userid_and_status_code
+    else:
+        userid, status_code = userid_and_status_code
+        if status_code != 200:
+            return util.error_message_string("users", username, status_code)
+    variables = {"userId": userid}
 
     if not run_query:
         r_and_status_code = util.userslug_to_userid(username, run_query=False)
         assert isinstance(r_and_status_code, str)
         r = r_and_status_code
-        return r + "\n\n" + query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return r + "\n\n" + GET_COMMENTS_FOR_USER.show(dict(variables, limit=limit or COMMENTS_PAGE_SIZE, offset=0))
 
-    request = util.send_query(query, operation_name="get_comments_for_user")
     result = []
-    comments_and_status_code = util.get_from_request(request, ['data', 'comments', 'results'])
+    if limit is None:
+        comments_and_status_code = util.fetch_all_pages(GET_COMMENTS_FOR_USER, variables,
+                                                        ['data', 'comments', 'results'], COMMENTS_PAGE_SIZE)
+    else:
+        request = util.send_query(GET_COMMENTS_FOR_USER, dict(variables, limit=limit, offset=0))
+        comments_and_status_code = util.get_from_request(request, ['data', 'comments', 'results'])
     if isinstance(comments_and_status_code, str):
         comments = comments_and_status_code
     else:
@@ -262,16 +314,12 @@ def get_comments_for_user(username, run_query=True):
     return result
 
 
-def get_posts_for_user(username, run_query=True):
-    userid, status_code = util.userslug_to_userid(username, run_query=True)
-    if status_code != 200:
-        return f"Received status code of {status_code} from API endpoint."
-    query = ("""
-    {
+GET_POSTS_FOR_USER = queries.Query("get_posts_for_user", """
+    query get_posts_for_user($userId: String, $withBodies: Boolean!) {
       posts(input: {
         terms: {
           view: "userPosts"
-          userId: "%s"
+          userId: $userId
           limit: 50
           meta: null  # this seems to get both meta and non-meta posts
         }
@@ -279,24 +327,31 @@ def get_posts_for_user(username, run_query=True):
         results {
           _id
           title
-          pageUrl
+          pageUrl @include(if: $withBodies)
           postedAt
-          htmlBody
-          voteCount
-          baseScore
+          htmlBody @include(if: $withBodies)
           slug
         }
       }
     }
-    """ % userid)
+    """)
+
+
+def get_posts_for_user(username, run_query=True, with_bodies=False):
+    """The posts by a user. The HTML page only lists their titles, so the
+    bodies are only fetched if with_bodies is True (for the feed)."""
+    userid, status_code = util.userslug_to_userid(username, run_query=True)
+    if status_code != 200:
+        return f"Received status code of {status_code} from API endpoint."
+    variables = {"userId": userid, "withBodies": with_bodies}
 
     if not run_query:
         r_and_status_code = util.userslug_to_userid(username, run_query=False)
         assert isinstance(r_and_status_code, str)
         r = r_and_status_code
-        return r + "\n\n" + query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return r + "\n\n" + GET_POSTS_FOR_USER.show(variables)
 
-    request = util.send_query(query, operation_name="get_posts_for_user")
+    request = util.send_query(GET_POSTS_FOR_USER, variables)
     result = []
     posts, status_code = util.get_from_request(request, ['data', 'posts', 'results'])
     if status_code != 200:
@@ -310,6 +365,6 @@ if __name__ == "__main__":
         print("Unexpected number of arguments")
     else:
         if sys.argv[2] == "rss":
-            print(feed_for_user(sys.argv[1]))
+            util.print_chunks(feed_for_user(sys.argv[1]))
         else:
-            print(html_page_for_user(username=sys.argv[1], display_format=sys.argv[2]))
+            util.print_chunks(html_page_for_user(username=sys.argv[1], display_format=sys.argv[2]))
@@ -1,16 +1,71 @@
 #!/usr/bin/env python3
 
+import atexit
+import contextvars
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
+import functools
+import json
 import re
-from urllib.parse import quote
+import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any
 
 import linkpath
 import config
+import cache
+import knownids
+import mirror
+import queries
+import throttle
 import util
 
+# Settings for the HTTP client used by send_query. These can be overridden in
+# config.py; see config_sample.py.
+HTTP_POOL_SIZE = getattr(config, "HTTP_POOL_SIZE", 10)
+HTTP_TIMEOUT = (getattr(config, "HTTP_CONNECT_TIMEOUT", 5),
+                getattr(config, "HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = getattr(config, "HTTP_RETRIES", 2)
+# Number of windows of a long list that fetch_all_pages requests at once
+PAGE_CONCURRENCY = getattr(config, "PAGE_CONCURRENCY", 4)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Queries currently being sent by some thread, by cache key, so that other
+# threads wanting the same response can wait for it instead of sending the
+# query again
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# Queries being refreshed in the background after a stale response was served,
+# by cache key
+_refreshing = {}
+_refreshing_lock = threading.Lock()
+
+# Whether send_query should skip the response cache (see skip_response_cache)
+_skip_cache = contextvars.ContextVar("skip_cache", default=False)
+
+# Links to the forums inside post and comment bodies, which
+# substitute_alt_links rewrites to point at the reader
+_FORUM_LINK = r'(<a[^>]+href=")(https?://(?:www\.|forum\.)(?:lesswrong\.com|greaterwrong\.com|effectivealtruism\.org|alignmentforum\.org)/[^"]+)("[^>]*>.*?</a>)'
+FORUM_LINK_RE = re.compile(_FORUM_LINK)
+_STRAY_TAG = r'</?(?:html|body|head)>'
+STRAY_TAG_RE = re.compile(_STRAY_TAG)
+# The same links, plus the stray tags that cleanHtmlBody removes, so that
+# clean_html_body does both in one pass over the body
+FORUM_LINK_OR_STRAY_TAG_RE = re.compile(_FORUM_LINK + '|' + _STRAY_TAG)
+
+COMMENT_URL_RE = re.compile(r'https?://((?:www|ea|forum)\.(?:greaterwrong\.com|effectivealtruism\.org|lesswrong\.com|alignmentforum\.org))(/posts/[a-zA-Z0-9]+/[^/]+)(?:/comment/|/answer/|#|#comment-|\?commentId=)([a-zA-Z0-9]+)$')
+POST_OR_USER_URL_RE = re.compile(r'https?://((?:www|ea|forum)\.(?:greaterwrong\.com|effectivealtruism\.org|lesswrong\.com|alignmentforum\.org))(/posts/[a-zA-Z0-9]+/[^/]+|/users/[^/#]+)$')
+
+
 def htmlescape(string):
     return string.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&#34;')
 
@@ -25,10 +80,16 @@ def _safe_get(obj, key, default=None):
 
     Since obj can be None, _safe_get can also be nested without checking for
     None each time: _safe_get(_safe_get({}, "a"), "b", 1) is 1. Thus in some
-    cases a default need only be specified at the end."""
+    cases a default need only be specified at the end.
+
+    If obj is a list, key is an index into it (as for the Algolia results in
+    search.py)."""
     if obj is None:
         return default
-    result = obj.get(key)
+    if isinstance(obj, list):
+        result = obj[key] if isinstance(key, int) and -len(obj) <= key < len(obj) else None
+    else:
+        result = obj.get(key)
     if result is None:
         result = default
     return result
@@ -90,21 +151,20 @@ def legacy_link(legacy_slug):
 
 
 def show_head(title, author="", date="", publisher="", widepage=False, canonical_url=""):
+    return (show_head_start(widepage=widepage) +
+            show_head_end(title, author=author, date=date, publisher=publisher,
+                          canonical_url=canonical_url))
+
+
+def show_head_start(widepage=False):
+    """The part of <head> that doesn't depend on the page content, i.e.
+    everything except the metadata and the closing tag. Pages that need to
+    wait for the API can send this right away and call show_head_end once the
+    content has arrived."""
     result = ("""
     <head>
         <meta charset="utf-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0, user-scalable=yes">
-        %s
-        %s
-        %s
-        <meta property="og:title" content="%s" />
-        <meta property="og:locale" content="en_US" />
-        <meta property="og:type" content="article" />
-        <meta name="citation_title" content="%s">
-        %s
-        %s
-        <meta name="citation_fulltext_world_readable" content="">
-        <title>%s</title>
         <style type="text/css">
             body {
                 font-family: Lato, Helvetica, sans-serif;
@@ -171,14 +231,6 @@ def show_head(title, author="", date="", publisher="", widepage=False, canonical
             .spoiler:not(:hover) { color: transparent; }
             .spoiler:not(:hover) > * { opacity: 0; }
     """ % (
-            '''<meta name="author" content="%s">''' % htmlescape(author) if author else "",
-            '''<meta name="dcterms.date" content="%s">''' % htmlescape(date) if date else "",
-            '''<link rel="canonical" href="%s">''' % htmlescape(canonical_url) if canonical_url else "",
-            htmlescape(title),
-            htmlescape(title),
-            '''<meta name="citation_author" content="%s">''' % htmlescape(author) if author else "",
-            '''<meta name="citation_publication_date" content="%s">''' % htmlescape(date) if date else "",
-            htmlescape(title),
             config.LINK_COLOR,
             config.LINK_COLOR
         )
@@ -249,12 +301,39 @@ def show_head(title, author="", date="", publisher="", widepage=False, canonical
 
     result += """
         </style>
-    </head>
     """
 
     return result
 
 
+def show_head_end(title, author="", date="", publisher="", canonical_url=""):
+    result = ("""
+        %s
+        %s
+        %s
+        <meta property="og:title" content="%s" />
+        <meta property="og:locale" content="en_US" />
+        <meta property="og:type" content="article" />
+        <meta name="citation_title" content="%s">
+        %s
+        %s
+        <meta name="citation_fulltext_world_readable" content="">
+        <title>%s</title>
+    </head>
+    """ % (
+            '''<meta name="author" content="%s">''' % htmlescape(author) if author else "",
+            '''<meta name="dcterms.date" content="%s">''' % htmlescape(date) if date else "",
+            '''<link rel="canonical" href="%s">''' % htmlescape(canonical_url) if canonical_url else "",
+            htmlescape(title),
+            htmlescape(title),
+            '''<meta name="citation_author" content="%s">''' % htmlescape(author) if author else "",
+            '''<meta name="citation_publication_date" content="%s">''' % htmlescape(date) if date else "",
+            htmlescape(title),
+        )
+    )
+    return result
+
+
 def show_navbar(navlinks=None, search_value=""):
     if navlinks is None:
         navlinks = []
@@ -281,7 +360,79 @@ def show_navbar(navlinks=None, search_value=""):
     return result
 
 
-def send_query(query, operation_name=None):
+def get_session() -> requests.Session:
+    """Return the HTTP session shared by everything in this process that talks
+    to the API endpoint (or to Algolia). The session keeps connections alive, so
+    only the first query of a page pays for the TCP and TLS handshake; the
+    remaining queries reuse a pooled connection."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=HTTP_RETRIES,
+                          backoff_factor=0.5,
+                          status_forcelist=[502, 503, 504],
+                          allowed_methods=["GET", "POST"],
+                          raise_on_status=False,
+                          # Retry-After is handled by throttle.py, which
+                          # stops all requests instead of tying up this one
+                          respect_retry_after_header=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                  pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def run_concurrently(*calls):
+    """Call each of the given zero-argument functions in its own thread and
+    return their results as a list, in the same order as the calls. This is
+    meant for queries that don't depend on each other, so that a page takes as
+    long as its slowest query rather than the sum of all of them. If a call
+    raises, the exception is re-raised here."""
+    if len(calls) <= 1:
+        return [call() for call in calls]
+    return [future.result() for future in start_concurrently(*calls)]
+
+
+def start_concurrently(*calls):
+    """Like run_concurrently, but return a list of futures right away instead
+    of waiting for the results. Renderers use this to send the start of a page
+    while its queries are still running."""
+    # Each thread runs in a copy of the current context, so that stale
+    # responses used by the queries show up in stale_notice
+    cache.track_stale()
+    executor = ThreadPoolExecutor(max_workers=max(len(calls), 1))
+    futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+    executor.shutdown(wait=False)
+    return futures
+
+
+def print_chunks(chunks):
+    """Print a page produced by one of the streaming renderers."""
+    for chunk in chunks:
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+
+
+def skip_response_cache():
+    """From now on, have send_query in this context (this thread, and the
+    threads it starts with start_concurrently or run_concurrently) always ask
+    the API endpoint, and leave the response cache alone. For copying data
+    into the mirror, which needs the current version of everything and would
+    only push the site's own responses out of the cache."""
+    _skip_cache.set(True)
+
+
+def send_query(query, variables=None):
+    """Send query (a queries.Query) with the given variables to the API
+    endpoint, or get the response from the cache (unless skip_response_cache
+    has been called)."""
+    variables = variables or {}
+    operation_name = query.name
     email = config.EMAIL
     headers = {'User-Agent': f'LW and EA Forum Reader (https://github.com/riceissa/ea-forum-reader; contact: {email})'}
 
@@ -292,16 +443,217 @@ def send_query(query, operation_name=None):
     # it would be good if the value somehow corresponded to the query, so for
     # now I've changed all calls to send_query to use the function name as the
     # operation_name.
-    if operation_name:
-        headers['X-Apollo-Operation-Name'] = operation_name
-    else:
-        headers['X-Apollo-Operation-Name'] = "default_operation"
+    headers['X-Apollo-Operation-Name'] = operation_name
+    # Everything needed to send the request, in a form that can be handed to
+    # the refresh process (see _finish_refreshes)
+    spec = {"operation_name": operation_name, "query": query.text, "sha256": query.sha256,
+            "variables": variables, "headers": headers}
+    if _skip_cache.get():
+        return _upstream_get(spec)
+
+    key = cache.response_key(config.GRAPHQL_URL, operation_name, variables, query.sha256)
+    cache.track_stale()
+    entry = cache.get_entry(key)
+    if entry is not None:
+        body, created, expires = entry
+        age_past_expiry = time.time() - expires
+        if age_past_expiry < 0:
+            return cache.CachedResponse(body)
+        if age_past_expiry < cache.STALE_WHILE_REVALIDATE:
+            _refresh_in_background(key, spec)
+            cache.note_stale(created)
+            return cache.CachedResponse(body)
 
-    return requests.get(config.GRAPHQL_URL, params={'query': query}, headers=headers)
+    try:
+        request = _coalesced_fetch(key, spec)
+    except requests.RequestException:
+        if entry is None or age_past_expiry >= cache.STALE_IF_ERROR:
+            raise
+        request = None
+    if (request is None or request.status_code != 200) and entry is not None and age_past_expiry < cache.STALE_IF_ERROR:
+        # Better an old copy than an error message
+        cache.note_stale(created)
+        return cache.CachedResponse(body)
+    return request
+
+
+def _coalesced_fetch(key, spec):
+    # When many people open the same page at once, only one upstream request
+    # is sent for each query: other threads in this process wait for the
+    # thread already sending it, and other processes wait on the cache lock
+    # and then find the response in the cache.
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        return future.result()
+    try:
+        future.set_result(_fetch_query(key, spec))
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+    return future.result()
+
+
+def _refresh_in_background(key, spec):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing[key] = spec
+
+    def refresh():
+        try:
+            _coalesced_fetch(key, spec)
+        except requests.RequestException:
+            pass
+        finally:
+            with _refreshing_lock:
+                _refreshing.pop(key, None)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+@atexit.register
+def _finish_refreshes():
+    """When run from the command line (as the PHP pages do), the process exits
+    right after printing the page, which would kill any refreshes still
+    running. Rather than make the page wait for them, hand them over to a
+    separate process (see the bottom of this file) that carries on after we
+    have exited."""
+    with _refreshing_lock:
+        pending = list(_refreshing.items())
+    if not pending:
+        return
+    try:
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--refresh"],
+                                 stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.DEVNULL, start_new_session=True)
+        child.stdin.write(json.dumps(pending).encode("utf-8"))
+        child.stdin.close()
+    except OSError:
+        pass
+
+
+def _fetch_query(key, spec):
+    operation_name = spec["operation_name"]
+    ttl = cache.ttl_for(operation_name)
+    if ttl <= 0:
+        # Nothing will be cached, so there's no point waiting for other processes
+        return _upstream_get(spec)
+    with cache.lock(key):
+        cached = cache.get(key)
+        if cached is not None:
+            return cache.CachedResponse(cached)
+        request = _upstream_get(spec)
+        if request.status_code != 200:
+            return request
+        try:
+            decoded = request.json()
+        except ValueError:
+            decoded = None
+        if not isinstance(decoded, dict):
+            # Not a GraphQL response at all (e.g. an error page from a proxy)
+            return request
+        data = decoded.get("data")
+        if isinstance(data, dict) and data:
+            if decoded.get("errors") or _is_missing_result(data):
+                # Part of the query failed, which may well be temporary, or
+                # the document doesn't exist (yet)
+                ttl = min(ttl, cache.NEGATIVE_TTL)
+            else:
+                knownids.note_response(data)
+                cache.remember_user_slugs(_user_slugs_in(data))
+            cache.put(key, operation_name, request.content, ttl)
+        # The body has been decoded already, so the caller doesn't need to do
+        # it again
+        return cache.CachedResponse(request.content, decoded=decoded)
+
+
+def _is_missing_result(data):
+    """Whether the data of a response says that the document asked for (a
+    post, user, tag or sequence selected by ID or slug) doesn't exist: all of
+    its fields are null, or have a null "result"."""
+    if not isinstance(data, dict) or not data:
+        return False
+    return all(value is None or (isinstance(value, dict) and "result" in value and value["result"] is None)
+               for value in data.values())
+
+
+def _user_slugs_in(data):
+    """The (slug, user ID) pairs in the data of a response: users fetched
+    with both _id and slug (e.g. by userslug_to_userid, query_user_info,
+    users_list_query or query_users), and comments and posts fetched with both userId and
+    user { slug }."""
+    pairs = set()
+    # Each item is a value along with the name of the GraphQL field it came
+    # from, skipping over "result" and "results"
+    stack = [(None, data)]
+    while stack:
+        field, value = stack.pop()
+        if isinstance(value, dict):
+            if ((field in ("user", "users", "coauthors") or "username" in value)
+                    and value.get("_id") and value.get("slug")):
+                pairs.add((value["slug"], value["_id"]))
+            if value.get("userId") and safe_get(value, ["user", "slug"]):
+                pairs.add((value["user"]["slug"], value["userId"]))
+            for key, child in value.items():
+                stack.append((field if key in ("result", "results") else key, child))
+        elif isinstance(value, list):
+            stack.extend((field, item) for item in value)
+    return pairs
+
+
+def _upstream_get(spec):
+    """Send the query described by spec to the API endpoint, unless the circuit
+    breaker or the rate limiter in throttle.py says not to."""
+    operation_name = spec["operation_name"]
+    if not throttle.allow(operation_name):
+        return throttle.RejectedResponse()
+    params = {'operationName': operation_name,
+              'variables': queries.canonical_json(spec["variables"])}
+    try:
+        request = None
+        if queries.PERSISTED_QUERIES:
+            # Send only the hash; if the API endpoint doesn't know it yet,
+            # send the query along with it so that it does next time
+            params['extensions'] = queries.canonical_json(
+                {"persistedQuery": {"version": 1, "sha256Hash": spec["sha256"]}})
+            request = get_session().get(config.GRAPHQL_URL, params=params,
+                                        headers=spec["headers"], timeout=HTTP_TIMEOUT)
+        if request is None or _persisted_query_not_found(request):
+            params['query'] = spec["query"]
+            request = get_session().get(config.GRAPHQL_URL, params=params,
+                                        headers=spec["headers"], timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        throttle.record(operation_name, None)
+        raise
+    throttle.record(operation_name, request)
+    return request
+
+
+def _persisted_query_not_found(request):
+    """Whether the API endpoint answered a request that only had the hash of
+    the query by saying that it doesn't know the hash."""
+    if request.status_code not in (200, 400):
+        return False
+    try:
+        errors = request.json().get("errors") or []
+    except (ValueError, AttributeError):
+        return False
+    return any(safe_get(error, ["extensions", "code"]) == "PERSISTED_QUERY_NOT_FOUND"
+               or safe_get(error, ["message"]) == "PersistedQueryNotFound"
+               for error in errors if isinstance(error, dict))
 
 def error_message_string(content_type, content_id, status_code):
     result = "<pre>"
-    result += f"Received a status code of {status_code} from the API endpoint.\n"
+    if status_code == 404:
+        result += "There doesn't seem to be anything here.\n"
+    else:
+        result += f"Received a status code of {status_code} from the API endpoint.\n"
     if status_code == 403:
         service = "LessWrong" if "lesswrong" in config.GRAPHQL_URL else "the Effective Altruism Forum"
         result += f"This probably means that Issa's server is being blocked by {service}.\n"
@@ -325,54 +677,183 @@ def error_message_string(content_type, content_id, status_code):
     result += "</pre>\n"
     return result
 
+
+def error_page(content_type, content_id, status_code, head_started=False):
+    """A complete page showing error_message_string. Pages that have already
+    sent show_head_start pass head_started=True to get just the rest of it."""
+    result = "" if head_started else "<!DOCTYPE html>\n<html>\n" + show_head_start()
+    result += show_head_end(title="Not found" if status_code == 404 else "Error")
+    result += "<body>\n"
+    result += show_navbar()
+    result += error_message_string(content_type, content_id, status_code)
+    result += "</body>\n</html>\n"
+    return result
+
+
+def stale_notice():
+    """If any of the responses used for the page were stale copies from the
+    cache, return a notice saying when they were cached, to go at the end of
+    the page."""
+    since = cache.stale_since()
+    if since is None:
+        return ""
+    cached_at = datetime.datetime.fromtimestamp(since, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+    return ('''<p style="position: fixed; bottom: 0; right: 0; margin: 0; padding: 3px 8px; font-size: 12px; background-color: #FFFFE0; border: 1px solid #B3B3B3;">''' +
+            "Some of this page was cached at %s UTC and may be out of date.</p>\n" % cached_at)
+
 def cleanHtmlBody(htmlBody):
     """For some reason htmlBody values often have the following tags that
     really shouldn't be there."""
     if htmlBody is None:
         return ""
-    return (htmlBody.replace("<html>", "")
-                    .replace("</html>", "")
-                    .replace("<body>", "")
-                    .replace("</body>", "")
-                    .replace("<head>", "")
-                    .replace("</head>", ""))
+    return STRAY_TAG_RE.sub("", htmlBody)
 
 
-def userid_to_userslug(userid: str) -> tuple[str, int]:
-    query = ("""
-    {
-      user(input: {selector: {documentId: "%s"}}) {
+def clean_html_body(html_body):
+    """Equivalent to cleanHtmlBody(substitute_alt_links(html_body)), but done
+    in a single pass over the body with one precompiled regex."""
+    if not html_body:
+        return ""
+    return FORUM_LINK_OR_STRAY_TAG_RE.sub(_convert_url_or_strip, html_body)
+
+
+USERID_TO_USERSLUG = queries.Query("userid_to_userslug", """
+    query userid_to_userslug($userId: String) {
+      user(input: {selector: {documentId: $userId}}) {
         result {
           _id
           slug
         }
       }
     }
-    """ % userid)
+    """)
+
 
-    request = send_query(query, operation_name="userid_to_userslug")
+def userid_to_userslug(userid: str) -> tuple[str, int]:
+    userslug = cache.slug_for_userid(userid)
+    if userslug:
+        return (userslug, 200)
+    request = send_query(USERID_TO_USERSLUG, {"userId": userid})
     return util.get_from_request(request, ['data', 'user', 'result', 'slug'])
 
 
-def userslug_to_userid(userslug, run_query=True):
-    query = ("""
-    {
-      user(input: {selector: {slug: "%s"}}) {
+USERSLUG_TO_USERID = queries.Query("userslug_to_userid", """
+    query userslug_to_userid($slug: String) {
+      user(input: {selector: {slug: $slug}}) {
         result {
           _id
           slug
         }
       }
     }
-    """ % userslug)
+    """)
+
 
+def userslug_to_userid(userslug, run_query=True):
     if not run_query:
-        return query + ('''\n<a href="%s">Run this query</a>\n\n''' % (config.GRAPHQL_URL.replace("graphql", "graphiql") + "?query=" + quote(query)))
+        return USERSLUG_TO_USERID.show({"slug": userslug})
 
-    request = send_query(query)
+    userid = cache.userid_for_slug(userslug)
+    if userid:
+        return (userid, 200)
+    request = send_query(USERSLUG_TO_USERID, {"slug": userslug})
     return util.get_from_request(request, ['data', 'user', 'result', '_id'])
 
 
+def fetch_all_pages(query, variables, keys, page_size):
+    """Fetch every result of query, which must take $limit and $offset
+    variables, a window of page_size results at a time. The first window is
+    fetched on its own, since most lists fit in one; if it is full, the
+    following windows are fetched PAGE_CONCURRENCY at a time until one comes
+    back short. The windows are merged in order, dropping results that show
+    up twice because the list changed between requests. Returns a tuple (list
+    of results, status code)."""
+    def fetch(offset):
+        request = send_query(query, dict(variables, limit=page_size, offset=offset))
+        return get_from_request(request, keys, default=[])
+
+    results = []
+    seen = set()
+    offset = 0
+    windows = [lambda: fetch(0)]
+    while True:
+        for page, status_code in run_concurrently(*windows):
+            if status_code != 200:
+                return (results, status_code)
+            for result in page or []:
+                if result.get("_id") not in seen:
+                    seen.add(result.get("_id"))
+                    results.append(result)
+            if len(page or []) < page_size:
+                return (results, 200)
+            offset += page_size
+        windows = [lambda offset=offset + i * page_size: fetch(offset)
+                   for i in range(PAGE_CONCURRENCY)]
+
+
+# Number of users fetched in a single request by query_users
+USERS_BATCH_SIZE = 50
+
+
+@functools.lru_cache(maxsize=None)
+def users_query(count):
+    """The query for count users by ID, with the i-th user (variable $user<i>)
+    under the alias user<i>."""
+    arguments = ", ".join("$user%s: String" % i for i in range(count))
+    parts = []
+    for i in range(count):
+        parts.append("""
+      user%s: user(input: {selector: {documentId: $user%s}}) {
+        result {
+          _id
+          username
+          displayName
+          slug
+          bio
+        }
+      }""" % (i, i))
+    return queries.Query("query_users", "\n    query query_users(%s) {%s\n    }\n    " % (arguments, "".join(parts)))
+
+
+def query_users(userids, run_query=True):
+    """Fetch each distinct user in userids once, in aliased batches of
+    USERS_BATCH_SIZE users sent concurrently; users in the mirror (see
+    mirror.py) aren't fetched at all. Returns a tuple (dict mapping user ID
+    to user, status code)."""
+    if not run_query:
+        # The IDs only become known once the comments have been fetched
+        return users_query(1).show({"user0": "(user ID)"})
+    users = mirror.users(set(userid for userid in userids if userid))
+    userids = sorted(set(userid for userid in userids if userid and userid not in users))
+    batches = [userids[i:i + USERS_BATCH_SIZE] for i in range(0, len(userids), USERS_BATCH_SIZE)]
+
+    def fetch(batch):
+        request = send_query(users_query(len(batch)),
+                             {"user%s" % i: userid for i, userid in enumerate(batch)})
+        return get_from_request(request, ['data'])
+
+    for batch, (data, status_code) in zip(batches, run_concurrently(*[lambda batch=batch: fetch(batch) for batch in batches])):
+        if status_code != 200:
+            return (users, status_code)
+        for i, userid in enumerate(batch):
+            user = safe_get(data, ["user%s" % i, "result"])
+            if user:
+                users[userid] = user
+    return (users, 200)
+
+
+def join_users(documents):
+    """Comments and answers are fetched with just the ID of their author
+    rather than a nested user { ... } (which would repeat the same user for
+    every comment they wrote), so fetch each author once and attach them to
+    documents as "user". Documents whose author can't be fetched are left
+    without one, as for deleted users."""
+    users, _ = query_users([document.get("userId") for document in documents])
+    for document in documents:
+        document["user"] = users.get(document.get("userId"))
+    return documents
+
+
 def userlink(slug=None, username=None, display_name=None, bio=None):
     if slug:
         displayed = username if username else slug
@@ -397,6 +878,14 @@ def gw_link(page_url):
     return '''<a href="%s" title="GreaterWrong link">GW</a>''' % official_url_to_gw(page_url)
 
 def alt_urls(original_url, is_answer=False):
+    # The same URLs come up over and over (e.g. a post linked from many of
+    # its comments), so the work is memoized. We hand out a copy so that
+    # callers can't change the memoized value.
+    return dict(_alt_urls(original_url, is_answer))
+
+
+@functools.lru_cache(maxsize=4096)
+def _alt_urls(original_url, is_answer=False):
     """Return a dictionary of URLs for all the alternative services (official,
     GW, my reader). Supported keys are: official, official_permalink, gw,
     gw_permalink, reader.
@@ -412,14 +901,14 @@ def alt_urls(original_url, is_answer=False):
     For post URLs, the permalink keys will not exist."""
     anchor = None
     try:
-        domain, path, comment_id = re.match(r'https?://((?:www|ea|forum)\.(?:greaterwrong\.com|effectivealtruism\.org|lesswrong\.com|alignmentforum\.org))(/posts/[a-zA-Z0-9]+/[^/]+)(?:/comment/|/answer/|#|#comment-|\?commentId=)([a-zA-Z0-9]+)$', original_url).groups()
+        domain, path, comment_id = COMMENT_URL_RE.match(original_url).groups()
         # Keep track of a list of common anchors that are not comment anchors
         if comment_id in ["comments"]:
             anchor = comment_id
             comment_id = None
     except AttributeError:
         try:
-            domain, path = re.match(r'https?://((?:www|ea|forum)\.(?:greaterwrong\.com|effectivealtruism\.org|lesswrong\.com|alignmentforum\.org))(/posts/[a-zA-Z0-9]+/[^/]+|/users/[^/#]+)$', original_url).groups()
+            domain, path = POST_OR_USER_URL_RE.match(original_url).groups()
             comment_id = None
         except:
             print("We don't know how to deal with this URL: ", original_url, file=sys.stderr)
@@ -491,18 +980,40 @@ def convert_url(match):
     begin = match.group(1)
     original_url = match.group(2)
     end = match.group(3)
-    url_dict = alt_urls(original_url)
+    new_url, links = _converted_url(original_url)
+    return begin + new_url + end + " [" + links + "]"
+
+
+@functools.lru_cache(maxsize=4096)
+def _converted_url(original_url):
+    """Return the URL a link to original_url should point to, along with the
+    grouped alternative links to show after it."""
+    url_dict = _alt_urls(original_url)
     if url_dict["official"] != "?":
-        html = begin + url_dict["reader"] + end + " [" + grouped_links(url_dict) + "]"
+        return (url_dict["reader"], grouped_links(url_dict))
     else:
-        html = begin + original_url + end + " [" + grouped_links(url_dict) + "]"
-    return html
+        return (original_url, grouped_links(url_dict))
+
+
+def _convert_url_or_strip(match):
+    if match.group(2) is None:
+        # One of the stray tags
+        return ""
+    # The link text itself may contain stray tags too
+    return STRAY_TAG_RE.sub("", convert_url(match))
+
 
 def substitute_alt_links(html_body):
     if not html_body:
         return ""
-    result = html_body
-    result = re.sub(r'(<a[^>]+href=")(https?://(?:www\.|forum\.)(?:lesswrong\.com|greaterwrong\.com|effectivealtruism\.org|alignmentforum\.org)/[^"]+)("[^>]*>.*?</a>)',
-                    convert_url,
-                    result)
-    return result
+    return FORUM_LINK_RE.sub(convert_url, html_body)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--refresh"]:
+        # Refreshes handed over by _finish_refreshes
+        for key, spec in json.load(sys.stdin):
+            try:
+                _fetch_query(key, spec)
+            except requests.RequestException:
+                pass